@@ -0,0 +1,159 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.synthetic_data import get_synthetic_data
+from calculate_daily_growth_rate import TIME_RANGE, fit_country
+from utils.export import export_table
+from utils.rollup import GroupRollup
+from utils.weekly import aggregate_weekly
+from utils.who_data import WHO_NUMERIC_COLUMNS, get_who_data, read_who_csv
+
+# Timed and memory-tracked runs of the pipeline stages on synthetic WHO data.
+# Run with python -m benchmarks.run_benchmarks from the repository root. Every run
+# is saved in RESULTS_DIR and compared with the previous run of the same size.
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'results')
+STAGES = ['load', 'load_cached', 'aggregate', 'fit', 'resample', 'export']
+# a stage counts as a regression when it is this much slower than in the previous run
+REGRESSION_THRESHOLD = 1.2
+# ... and at least this many seconds slower, to ignore jitter on the fast stages
+MIN_REGRESSION_TIME = 0.05
+MIN_CUMULATIVE_CASES = 100
+REGION_SIZE = 10
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--countries', type=int, default=63, help='Number of synthetic countries')
+    parser.add_argument('-d', '--days', type=int, default=210, help='Number of days')
+    parser.add_argument('-n', '--noise', type=float, default=0.2, help='Relative noise on the new cases')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per stage, the fastest is kept')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='Stages to run')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='Slow down relative to the previous run that counts as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='Exit with an error code if a stage regressed')
+    return parser.parse_args()
+
+
+def measure(function, *args, repeat=1):
+    # fastest wall time and its CPU time over the runs, then the peak traced memory
+    # of one more run: tracing every allocation slows the code down, so it is not
+    # done while timing
+    timings = []
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = function(*args)
+        timings.append((time.perf_counter() - wall_start, time.process_time() - cpu_start))
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    wall_time, cpu_time = min(timings)
+    return result, {'wall_time': wall_time, 'cpu_time': cpu_time, 'peak_memory': peak_memory}
+
+
+def get_groups(iso3_list):
+    # all countries plus "regions" of REGION_SIZE countries, like H63 and the regional offices
+    groups = {'H63': list(iso3_list)}
+    for istart in range(0, len(iso3_list), REGION_SIZE):
+        groups[f'REGION{istart // REGION_SIZE}'] = list(iso3_list[istart:istart + REGION_SIZE])
+    return groups
+
+
+def fit_all(df):
+    fits = []
+    for iso3, df_country in df.groupby('ISO_3_CODE'):
+        df_country = df_country[df_country['CumCase'] > MIN_CUMULATIVE_CASES].reset_index(drop=True)
+        nwindows = max(len(df_country) - max(TIME_RANGE.values()) + 1, 0)
+        fits.append(fit_country(df_country, nwindows))
+    return fits
+
+
+def export(output_df, output_dir):
+    output_df = output_df.copy()
+    output_df['date_epicrv'] = output_df['date_epicrv'].apply(lambda x: x.strftime('%Y-%m-%d'))
+    export_table(output_df, os.path.join(output_dir, 'benchmark'), 'ISO_3_CODE')
+
+
+def run_benchmarks(countries=63, days=210, noise=0.2, repeat=3, stages=STAGES):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, 'who_synthetic.csv')
+        get_synthetic_data(countries, days, noise).to_csv(filename, index=False)
+        # the snapshot of the synthetic data is kept in the temporary directory too
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        df, results['load'] = measure(read_who_csv, filename, repeat=repeat)
+        get_who_data(filename, cache_dir=cache_dir)
+        if 'load_cached' in stages:
+            _, results['load_cached'] = measure(get_who_data, filename, None, cache_dir, repeat=repeat)
+        groups = get_groups(sorted(df['ISO_3_CODE'].unique()))
+        if 'aggregate' in stages:
+            # a new rollup every time so that its cache does not count
+            _, results['aggregate'] = measure(
+                lambda: GroupRollup(groups).rollup_series(df, WHO_NUMERIC_COLUMNS), repeat=repeat)
+        if 'fit' in stages:
+            _, results['fit'] = measure(fit_all, df, repeat=repeat)
+        weekly_df, stats = measure(aggregate_weekly, df, repeat=repeat)
+        if 'resample' in stages:
+            results['resample'] = stats
+        if 'export' in stages:
+            _, results['export'] = measure(export, weekly_df, tmp_dir, repeat=repeat)
+    return {stage: stats for stage, stats in results.items() if stage in stages}
+
+
+def get_previous_results(config):
+    # latest saved run with the same configuration
+    for filename in sorted(glob.glob(os.path.join(RESULTS_DIR, 'benchmark_*.json')), reverse=True):
+        with open(filename, 'r') as stream:
+            previous = json.load(stream)
+        if previous['config'] == config:
+            return previous
+    return None
+
+
+def compare(results, previous, threshold=REGRESSION_THRESHOLD):
+    # print the stages side by side with the previous run, return the regressed ones
+    regressions = []
+    print(f'{"stage":<12}{"wall [s]":>10}{"cpu [s]":>10}{"peak [MB]":>11}{"previous [s]":>14}{"ratio":>8}')
+    for stage, stats in results['stages'].items():
+        line = f'{stage:<12}{stats["wall_time"]:>10.3f}{stats["cpu_time"]:>10.3f}{stats["peak_memory"] / 1e6:>11.1f}'
+        previous_stats = previous['stages'].get(stage) if previous else None
+        if previous_stats:
+            ratio = stats['wall_time'] / previous_stats['wall_time']
+            line += f'{previous_stats["wall_time"]:>14.3f}{ratio:>8.2f}'
+            if ratio > threshold and stats['wall_time'] - previous_stats['wall_time'] > MIN_REGRESSION_TIME:
+                line += '  REGRESSION'
+                regressions.append(stage)
+        print(line)
+    return regressions
+
+
+def main(countries=63, days=210, noise=0.2, repeat=3, stages=STAGES, threshold=REGRESSION_THRESHOLD,
+         fail_on_regression=False):
+    config = {'countries': countries, 'days': days, 'noise': noise, 'repeat': repeat}
+    previous = get_previous_results(config)
+    results = {'config': config, 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'stages': run_benchmarks(countries, days, noise, repeat, stages)}
+    regressions = compare(results, previous, threshold)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    filename = os.path.join(RESULTS_DIR, f'benchmark_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    with open(filename, 'w') as stream:
+        json.dump(results, stream, indent=2)
+    print(f'Saved results to "{filename}"')
+    if regressions and fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(countries=args.countries, days=args.days, noise=args.noise, repeat=args.repeat, stages=args.stages,
+         threshold=args.threshold, fail_on_regression=args.fail_on_regression)
@@ -0,0 +1,78 @@
+import argparse
+import datetime
+import itertools
+import string
+
+import numpy as np
+import pandas as pd
+
+# Run with python -m benchmarks.synthetic_data from the repository root.
+# Synthetic input in the format of the WHO COVID-19 file, to benchmark the
+# pipelines on more countries and longer histories than the real data has.
+WHO_HEADER = ['OBJECTID', 'ISO_2_CODE', 'ISO_3_CODE', 'ADM0_NAME', 'date_epicrv', 'NewCase', 'CumCase',
+              'NewDeath', 'CumDeath', 'Short_Name_ZH', 'Short_Name_FR', 'Short_Name_ES', 'Short_Name_RU',
+              'Short_Name_AR']
+START_DATE = datetime.date(2020, 1, 4)
+CASE_FATALITY_RATE = 0.02
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help='CSV file to write')
+    parser.add_argument('-c', '--countries', type=int, default=63, help='Number of countries')
+    parser.add_argument('-d', '--days', type=int, default=210, help='Number of days')
+    parser.add_argument('-n', '--noise', type=float, default=0.2,
+                        help='Relative day to day noise on the new cases')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Random seed')
+    return parser.parse_args()
+
+
+def get_iso3_codes(ncountries):
+    # codes that are not real ISO3 codes (they start with X): the 676 three letter
+    # ones, then four letters and so on (like sub-national codes) for more countries
+    codes = (''.join(letters) for length in itertools.count(2)
+             for letters in itertools.product(string.ascii_uppercase, repeat=length))
+    return ['X' + code for code in itertools.islice(codes, ncountries)]
+
+
+def get_synthetic_data(ncountries=63, ndays=210, noise=0.2, seed=0):
+    """
+    One logistic epidemic curve per country, with random size, growth rate and start
+    date, and multiplicative noise on the daily new cases.
+    """
+    rng = np.random.default_rng(seed)
+    iso3_codes = get_iso3_codes(ncountries)
+    days = np.arange(ndays)
+    size = 10 ** rng.uniform(3, 6, ncountries)
+    growth_rate = rng.uniform(0.03, 0.15, ncountries)
+    midpoint = rng.uniform(0.3, 0.9, ncountries) * ndays
+    cumulative = size[:, None] / (1 + np.exp(-growth_rate[:, None] * (days[None, :] - midpoint[:, None])))
+    new_cases = np.diff(cumulative, axis=1, prepend=0.)
+    new_cases = rng.poisson(new_cases * rng.lognormal(0, noise, new_cases.shape))
+    new_deaths = rng.binomial(new_cases, CASE_FATALITY_RATE)
+    dates = [(START_DATE + datetime.timedelta(days=int(day))).strftime('%Y-%m-%dT00:00:00.000Z') for day in days]
+    df = pd.DataFrame({
+        'ISO_2_CODE': np.repeat([code[1:] for code in iso3_codes], ndays),
+        'ISO_3_CODE': np.repeat(iso3_codes, ndays),
+        'ADM0_NAME': np.repeat([f'Country {code}' for code in iso3_codes], ndays),
+        'date_epicrv': np.tile(dates, ncountries),
+        'NewCase': new_cases.ravel(),
+        'CumCase': new_cases.cumsum(axis=1).ravel(),
+        'NewDeath': new_deaths.ravel(),
+        'CumDeath': new_deaths.cumsum(axis=1).ravel(),
+    })
+    df.insert(0, 'OBJECTID', np.arange(1, len(df) + 1))
+    for column in WHO_HEADER[9:]:
+        df[column] = df['ADM0_NAME']
+    return df[WHO_HEADER]
+
+
+def main(output, countries=63, days=210, noise=0.2, seed=0):
+    df = get_synthetic_data(countries, days, noise, seed)
+    df.to_csv(output, index=False)
+    print(f'Wrote {len(df)} rows for {countries} countries to "{output}"')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args.output, countries=args.countries, days=args.days, noise=args.noise, seed=args.seed)
@@ -1,77 +1,66 @@
-from calculate_weekly_increase import H25_iso3
-import pandas as pd
+import argparse
 import datetime
+import os
 
-# WHO_COVID_URL='https://docs.google.com/spreadsheets/d/e/2PACX-1vSe-8lf6l_ShJHvd126J-jGti992SUbNLu-kmJfx1IRkvma_r4DHi0bwEW89opArs8ZkSY5G2-Bc1yT/pub?gid=0&single=true&output=csv'
-WHO_COVID_URL='WHO_data/Data_ WHO Coronavirus Covid-19 Cases and Deaths - WHO-COVID-19-global-data.csv'
-MIN_CUMULATIVE_CASES = 100
-JUNE_19=datetime.date(2020, 6, 22)
-JULY_17=datetime.date(2020, 7, 22)
-H63_iso3=['ABW', 'AFG', 'AGO', 'ARG', 'BDI', 'BEN', 'BFA', 'BGD', 'BOL', 'BRA', 'CAF', 'CHL', 'CMR', 'COD', 'COG', 'COL', 'CRI', 'CUW', 'DJI', 'DOM', 'ECU', 'EGY', 'ETH', 'GUY', 'HTI', 'IRN', 'IRQ', 'JOR', 'KEN', 'LBN', 'LBR', 'LBY', 'MEX', 'MLI', 'MMR', 'MOZ', 'NER', 'NGA', 'PAK', 'PAN', 'PER', 'PHL', 'PRK', 'PRY', 'PSE', 'RWA', 'SDN', 'SLE', 'SOM', 'SSD', 'SYR', 'TCD', 'TGO', 'TTO', 'TUR', 'TZA', 'UGA', 'UKR', 'URY', 'VEN', 'YEM', 'ZMB', 'ZWE']
-H25_iso3=['AFG','BDI','BFA','CAF','CMR','COD','COL','ETH','HTI','IRQ','LBY','MLI','MMR','NER','NGA','PSE','SDN','SOM','SSD','SYR','TCD','UKR','VEN','YEM','ZWE']
+import pandas as pd
 
-def get_WHO_data(H63_iso3,H25_iso3):
-    df=pd.read_csv(f'{WHO_COVID_URL}')
-    # get only HRP countries
-    df = df.loc[df['ISO_3_CODE'].isin(H63_iso3),:]
-    df['date_epicrv']=pd.to_datetime(df['date_epicrv'])
-    df=df[['date_epicrv','ISO_3_CODE','CumCase','CumDeath']]
+from utils.countries import get_country_list
+from utils.export import write_xlsx
+from utils.periods import add_period_arguments, compare_periods, get_period, get_periods_from_args
+from utils.profiling import add_profile_arguments, profile_run, profile_stage
+from utils.rollup import get_group_rollup
+from utils.who_data import get_who_data
 
-    # adding global by date
-    df_H63=df.groupby('date_epicrv').sum()
-    df_H63['ISO_3_CODE']='H63'
-    df_H63=df_H63.reset_index()
+# WHO_COVID_URL='https://docs.google.com/spreadsheets/d/e/2PACX-1vSe-8lf6l_ShJHvd126J-jGti992SUbNLu-kmJfx1IRkvma_r4DHi0bwEW89opArs8ZkSY5G2-Bc1yT/pub?gid=0&single=true&output=csv'
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+WHO_COVID_FILENAME='WHO_data/Data_ WHO Coronavirus Covid-19 Cases and Deaths - WHO-COVID-19-global-data.csv'
+OUTPUT_FILENAME='HNO_increase'
+# periods compared when none are given
+PERIODS=[get_period(datetime.date(2020, 6, 22), datetime.date(2020, 7, 22), name='June-July', labels=['june', 'july'])]
 
-    # adding global H25 by date
-    df_H25=df.loc[df['ISO_3_CODE'].isin(H25_iso3),:]
-    df_H25=df_H25.groupby('date_epicrv').sum()
-    df_H25['ISO_3_CODE']='H25'
-    df_H25=df_H25.reset_index()
 
-    df=df.append(df_H63)
-    df=df.append(df_H25)
-    return df
+def parse_args():
+    parser = argparse.ArgumentParser()
+    add_period_arguments(parser)
+    parser.add_argument('--regions', action='store_true', help='Also compare the regional groups')
+    add_profile_arguments(parser, f'{OUTPUT_FILENAME}.profile.json')
+    args = parser.parse_args()
+    args.periods = get_periods_from_args(parser, args, PERIODS)
+    return args
+
+def main(periods=PERIODS, regions=False):
+    # Read in list of countries
+    with profile_stage('countries'):
+        H63_iso3 = get_country_list()
+    # get WHO data and the sums of the groups (H63, H25 and the regions if asked)
+    df_WHO=get_WHO_data(H63_iso3, regions)
+    # compare all the periods at once
+    with profile_stage('periods'):
+        output_tables = compare_periods(df_WHO, periods)
+    with profile_stage('export'):
+        save_period_increase(output_tables)
 
-df_WHO=get_WHO_data(H63_iso3,H25_iso3)
-# convert ot datetime
-df_WHO['date_epicrv']=pd.to_datetime(df_WHO['date_epicrv']).dt.date
-# filter date
-df_WHO=df_WHO[ (df_WHO['date_epicrv']>=JUNE_19) &\
-               (df_WHO['date_epicrv']<=JULY_17) ]
+def save_period_increase(output_tables):
+    filenames = []
+    for name, output_df in output_tables.items():
+        filenames.append(f'{OUTPUT_FILENAME}_{name}.xlsx')
+        write_xlsx(output_df, filenames[-1])
+        print(f'Saved the {name} increase of {len(output_df)} countries and groups to "{filenames[-1]}"')
+    return filenames
 
-output_fields = [
-    'iso3',
-    'june_cases',
-    'june_deaths',
-    'july_cases',
-    'july_deaths',
-    'increase_cases',
-    'pc_increase_cases',
-    'increase_deaths',
-    'pc_increase_deaths',
-    'CFR_june',
-    'CFR_july'
-    ]
-output_df = pd.DataFrame(columns=output_fields)
-for name,group in df_WHO.groupby('ISO_3_CODE'):
-    group=group.sort_values(by='date_epicrv',ascending=True)
-    june_index=group.index[0]
-    july_index=group.index[-1]
-    print(group)
-    data = {
-        'iso3':name,
-        'june_cases':group.loc[june_index,'CumCase'],
-        'june_deaths':group.loc[june_index,'CumDeath'],
-        'july_cases':group.loc[july_index,'CumCase'],
-        'july_deaths':group.loc[july_index,'CumDeath'],
-        'increase_cases':group.loc[july_index,'CumCase']-group.loc[june_index,'CumCase'],
-        'pc_increase_cases':(group.loc[july_index,'CumCase']-group.loc[june_index,'CumCase'])/group.loc[june_index,'CumCase']*100,
-        'increase_deaths':group.loc[july_index,'CumDeath']-group.loc[june_index,'CumDeath'],
-        'pc_increase_deaths':(group.loc[july_index,'CumDeath']-group.loc[june_index,'CumDeath'])/group.loc[june_index,'CumDeath']*100,
-        'CFR_june':group.loc[june_index,'CumDeath']/group.loc[june_index,'CumCase']*100,
-        'CFR_july':group.loc[july_index,'CumDeath']/group.loc[july_index,'CumCase']*100
-        }
-    output_df = output_df.append(pd.DataFrame([data]), ignore_index=True)
+def get_WHO_data(H63_iso3, regions=False):
+    # get only HRP countries
+    with profile_stage('ingest'):
+        df=get_who_data(f'{DIR_PATH}/{WHO_COVID_FILENAME}', H63_iso3)
+        df=df[['date_epicrv','ISO_3_CODE','CumCase','CumDeath']]
 
-output_df.to_excel('HNO_increase_June-July.xlsx')
+    # adding global, H25 (and regions) by date
+    with profile_stage('aggregate'):
+        df_groups=get_group_rollup(H63_iso3, regions=regions).rollup_series(df, ['CumCase','CumDeath'])
+        df=pd.concat([df, df_groups], ignore_index=True)
+    return df
 
+if __name__ == '__main__':
+    args = parse_args()
+    with profile_run(args.profile, args.profile_stats):
+        main(periods=args.periods, regions=args.regions)
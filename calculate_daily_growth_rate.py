@@ -1,156 +1,314 @@
+import argparse
+import contextlib
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 import numpy as np
 import datetime
 import os
-import yaml
 
-# filename for shapefile and WHO input dataset
+from utils.countries import get_country_list
+from utils.export import TableStreamWriter, add_json_arguments, export_table, get_json_filename
+from utils.growth_fit import DIAGNOSTIC_COLUMNS, FIT_VERSION, fit_windows, get_day_numbers, get_dense_series
+from utils.incremental import get_country_state, get_nwindows_to_update, get_state_filename, read_previous_output, \
+    read_state, write_state
+from utils.parallel import map_countries
+from utils.plotting import PLOTS_DIR, add_plot_arguments, plot_country_fits, render_panels
+from utils.profiling import add_profile_arguments, profile_run, profile_stage
+from utils.results import ResultCollector
+from utils.rollup import get_group_rollup
+from utils.streaming import STREAM_CHUNK_SIZE, GroupStream, StreamingRollup, WindowFitState, read_who_chunks
+from utils.who_data import get_who_data
+
+# filename for WHO input dataset
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 WHO_COVID_FILENAME='WHO_data/Data_ WHO Coronavirus Covid-19 Cases and Deaths - WHO-COVID-19-global-data.csv'
-FILENAME_SHP = 'ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
 # number of days to be selected for the analysis
 # use 15 days as reference with error bands from 7 and 30 days
 # additional uncertainity from comparison between fit and counts
 TIME_RANGE={'mid': 30, 'min': 15, 'max': 45}
 # TIME_RANGE={'mid': 30}
+# not fitting when there are less than 100 cases
+MIN_CUMULATIVE_CASES=100
+OUTPUT_FILENAME='hrp_covid_doubling_rates'
+DIAGNOSTICS_FILENAME=f'{OUTPUT_FILENAME}_diagnostics'
 
-# Suppress warnings that come from the doubling time calc
-np.seterr(divide='ignore')
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to fit the countries')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Only fit the dates that are new since the previous output')
+    parser.add_argument('--no-plots', action='store_true',
+                        help='Do not draw the fits (matplotlib is then not needed)')
+    add_plot_arguments(parser)
+    add_json_arguments(parser)
+    parser.add_argument('--no-diagnostics', action='store_true',
+                        help=f'Do not save the fit diagnostics of the windows fitted in this run ({DIAGNOSTICS_FILENAME})')
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the WHO data in chunks and write the output as it comes, in bounded memory; '
+                             'the rows have to be grouped by country in date order. The countries are written '
+                             'in the order of the input and H63 last. No plots are drawn')
+    parser.add_argument('--chunk-size', type=int, default=STREAM_CHUNK_SIZE,
+                        help='Rows of the WHO data read at a time with --stream (default %(default)s)')
+    add_profile_arguments(parser, f'{OUTPUT_FILENAME}.profile.json')
+    args = parser.parse_args()
+    if args.stream and args.incremental:
+        parser.error('--incremental cannot be used with --stream')
+    return args
 
-def main():
+def main(workers=1, incremental=False, plots=True, plots_dir=PLOTS_DIR, plot_format='png', compact_json=False,
+         gzip_json=False, diagnostics=True, stream=False, chunk_size=STREAM_CHUNK_SIZE):
     # Read in list of countries
-    with open('countries/admins.yaml', 'r') as stream:
-        country_list = yaml.safe_load(stream)['admin_info']
-    HRP_iso3 = sorted(list(set([country.get('alpha_3', None) for country in country_list])))
+    with profile_stage('countries'):
+        HRP_iso3 = get_country_list()
+    if stream:
+        save_doubling_rates_stream(get_doubling_rates_stream(HRP_iso3, chunk_size), compact_json, gzip_json,
+                                   diagnostics)
+        return
     # get WHO data and calculate sum as 'H63'
     df_WHO=get_WHO_data(HRP_iso3)
-    # create canvas
-    # TODO adjust rows and columns depending on the number of countries
-    fig,axs=plt.subplots(figsize=[15,10],nrows=8,ncols=8)
-    fig_HRP,axs_HRP=plt.subplots(figsize=[15,10],nrows=1,ncols=1)
+    # in incremental mode reuse the previous output for the countries whose data only got new dates
+    config = {'time_range': TIME_RANGE, 'min_cumulative_cases': MIN_CUMULATIVE_CASES, 'fit_version': FIT_VERSION}
+    json_filename = get_json_filename(OUTPUT_FILENAME, gzip_json)
+    previous_state = read_state(json_filename, config) if incremental else {}
+    previous_output = read_previous_output(json_filename) if previous_state else {}
+    output_df, df_countries, country_fits, country_state = get_doubling_rates(
+        df_WHO, HRP_iso3, workers, previous_state, previous_output)
+    # Save file
+    with profile_stage('export'):
+        save_doubling_rates(output_df, compact_json, gzip_json)
+        write_state(json_filename, config, country_state)
+        if diagnostics:
+            save_diagnostics(HRP_iso3, country_fits, compact_json, gzip_json)
+
+    # Plot the fits of every country from the fit tables
+    if plots:
+        with profile_stage('plots'):
+            plot_doubling_rates(HRP_iso3, df_countries, country_fits, plots_dir, plot_format, workers)
+
+def get_doubling_rates(df_WHO, HRP_iso3, workers=1, previous_state=None, previous_output=None):
+    """
+    Fit the countries (and groups) of HRP_iso3 and collect the growth rates and
+    doubling times of every date. The countries of previous_output whose data only
+    got new dates (see utils.incremental) are only fitted on these. Returns the
+    output table, the fitted rows and the fits of every country and their state.
+    """
+    previous_state = previous_state or {}
+    previous_output = previous_output or {}
     # create output df
     # TODO do we need a dictionary for the columns names?
-    output_df=pd.DataFrame(columns=['iso3','date','pc_growth_rate','doubling_time'])
-    # Loop over countries
-    for ifig,iso3 in enumerate(HRP_iso3):
+    results=ResultCollector(['iso3','date'],['pc_growth_rate','doubling_time'])
+    df_countries = []
+    nwindows_list = []
+    reuse_list = []
+    country_state = {}
+    for iso3 in HRP_iso3:
         df_country = df_WHO[df_WHO['ISO_3_CODE'] == iso3].reset_index()
         # not fitting when there are less than 100 cases
-        df_country=df_country[df_country['CumCase']>100]
-        axis = axs[ifig // 8][ifig % 8]
+        df_country = df_country[df_country['CumCase']>MIN_CUMULATIVE_CASES]
+        days = get_day_numbers(df_country['date_epicrv'])
+        values = df_country['CumCase'].values
+        country_state[iso3] = get_country_state(days, values)
+        nwindows = max(len(df_country) - max(TIME_RANGE.values()) + 1, 0)
+        nwindows_update = None
+        if iso3 in previous_output and nwindows > 0:
+            nwindows_update = get_nwindows_to_update(previous_state.get(iso3), days, values, nwindows)
+        df_countries.append(df_country)
+        nwindows_list.append(nwindows if nwindows_update is None else nwindows_update)
+        reuse_list.append(nwindows_update is not None)
+    # Fit the countries, possibly in parallel
+    with profile_stage('fit'):
+        country_fits = map_countries(fit_country, df_countries, nwindows_list, HRP_iso3, workers=workers)
+    # Loop over countries
+    for icountry,(iso3,df_country,(days,end_days,fits)) in enumerate(zip(HRP_iso3,df_countries,country_fits)):
         # Loop over the dates
         for iwindow, date in enumerate(df_country['date_epicrv'][::-1]):
-            if iwindow + max(TIME_RANGE.values()) > len(df_country):
+            if iwindow >= len(end_days):
                 break
             growth_rate_dict = {}
             doubling_time_fit_dict = {}
             doubling_time_val_dict = {}
             for time_type, time_range in TIME_RANGE.items():
-                df_date=get_df_date(df_country, date, time_range)
-                # start fit
-                x = df_date['day_fit']
-                initial_caseload=df_date['CumCase'].iloc[0]
-                initial_parameters=[initial_caseload,0.03]
-                popt, pcov = curve_fit(func,x,df_date['CumCase'],p0=initial_parameters)
-                # TODO check quality of the fit
+                fit = fits[time_type].iloc[iwindow]
                 # calculate growth rate and doubling time
-                growth_rate=np.exp(popt[1])-1
-                doubling_time_fit=np.log(2)/popt[1]
+                growth_rate=fit['growth_rate']
+                doubling_time_fit=fit['doubling_time_fit']
                 if doubling_time_fit<0:
                     continue
-                if time_type == 'mid':
-                    plot_mid_curve(axis,x,iwindow,df_date,func,popt,iso3)
-                    if iwindow == 0:
-                        plot_original_data(axis,df_country,iso3)
-                elif time_type in ['min', 'max']:
-                    plt_min_max_curves(axis,x,iwindow,func,popt,iso3)
-                
-                # large plot for global
-                if iso3=='H63':
-                    if time_type == 'mid':
-                        plot_mid_curve(axs_HRP,x,iwindow,df_date,func,popt,iso3)
-                        if iwindow == 0:
-                            plot_original_data(axis,df_country,iso3)
-                    elif time_type in ['min', 'max']:
-                        plt_min_max_curves(axs_HRP,x,iwindow,func,popt,iso3)
                 # altertnative way of calculating doubling time form observations
                 # This is using the first and the last observations and not the exponentinal fit
-                initial_val=df_date['CumCase'].iloc[0]
-                final_val=df_date['CumCase'].iloc[-1]
-                ndays=df_date['day_fit'].iloc[-1]
-                doubling_time_val=ndays*np.log(2)/np.log(final_val/initial_val)
+                doubling_time_val=fit['doubling_time_val']
                 # Append stuff to dicts
                 growth_rate_dict[time_type] = growth_rate
                 doubling_time_fit_dict[time_type] = doubling_time_fit
                 doubling_time_val_dict[time_type] = doubling_time_val
-                # TODO quality check: the two emasurements sohuld agree within 20%
-                # print values
+                # print values, the two measurements should agree within 20%
                 if iwindow == 0 and time_type == 'mid':
                     print(f'{iso3} Doubling time (fit): ',doubling_time_fit)
                     print(f'{iso3} Doubling time (values): ',doubling_time_val)
+                    if fit['poor_fit']:
+                        print(f'{iso3} Poor fit: the doubling times differ by {fit["doubling_time_diff"]:.0%}')
                 if time_type == 'mid':
-                    output_df=output_df.append({'iso3':iso3, 'date': date, 'pc_growth_rate':growth_rate*100,
-                                                'doubling_time':doubling_time_fit},ignore_index=True)
+                    results.set((iso3,date), pc_growth_rate=growth_rate*100, doubling_time=doubling_time_fit)
                 else:
-                    output_df.loc[(output_df['iso3'] == iso3) & (output_df['date'] == date),
-                                  f'pc_growth_rate_{time_type}_window'] = growth_rate * 100,
-                    output_df.loc[(output_df['iso3'] == iso3) & (output_df['date'] == date),
-                                  f'doubling_time_{time_type}_window'] = doubling_time_fit
-    # Add PRK
-    output_df = output_df.append({'iso3': 'PRK', 'date': datetime.datetime.today(), 'pc_growth_rate': 0.0 },
-                                 ignore_index=True)
-    # Save file
+                    # only fill in the dates that have a 'mid' result
+                    results.set((iso3,date), create=False,
+                                **{f'pc_growth_rate_{time_type}_window': growth_rate * 100,
+                                   f'doubling_time_{time_type}_window': doubling_time_fit})
+        if reuse_list[icountry]:
+            results.extend(previous_output[iso3])
+    return results.to_dataframe(), df_countries, country_fits, country_state
+
+def get_doubling_rates_stream(HRP_iso3, chunk_size=STREAM_CHUNK_SIZE):
+    # The fits of get_doubling_rates in pieces, one per chunk of the WHO data (see
+    # utils/streaming.py): lists of (iso3, (end_days, fits)), the countries first
+    # and H63 at the end, from its sum by date
+    rollup = StreamingRollup(get_group_rollup(HRP_iso3, custom_groups=False, regions=False), ['CumCase'])
+
+    def get_state(iso3):
+        return WindowFitState(TIME_RANGE, 'CumCase', MIN_CUMULATIVE_CASES)
+
+    country_stream = GroupStream(get_state)
+    for df in read_who_chunks(f'{DIR_PATH}/{WHO_COVID_FILENAME}', HRP_iso3, chunk_size):
+        with profile_stage('aggregate'):
+            rollup.add(df[['date_epicrv','ISO_3_CODE','CumCase']])
+        with profile_stage('fit'):
+            country_fits = country_stream.update(df)
+        if country_fits:
+            yield country_fits
+    group_stream = GroupStream(get_state)
+    with profile_stage('fit'):
+        country_fits = country_stream.finish() + group_stream.update(rollup.get_series()) + group_stream.finish()
+    if country_fits:
+        yield country_fits
+
+def merge_country_fits(fit_pieces):
+    # (iso3, end_days, fits) of every country of the pieces of get_doubling_rates_stream,
+    # latest window first as in get_doubling_rates. Only the pieces of the current
+    # country are kept, until the next country starts.
+    def merge(iso3, pieces):
+        end_days = np.concatenate([end_days for end_days, _ in pieces])[::-1]
+        fits = {time_type: pd.concat([fits[time_type] for _, fits in pieces], ignore_index=True)[::-1]
+                .reset_index(drop=True) for time_type in TIME_RANGE}
+        return iso3, end_days, fits
+
+    current_iso3, pieces = None, []
+    for country_fits in fit_pieces:
+        for iso3, piece in country_fits:
+            if iso3 != current_iso3 and pieces:
+                yield merge(current_iso3, pieces)
+                pieces = []
+            current_iso3 = iso3
+            pieces.append(piece)
+    if pieces:
+        yield merge(current_iso3, pieces)
+
+def get_window_rates(iso3, end_days, fits):
+    # the rows of get_doubling_rates for the windows of a country, in the order of end_days
+    output_df = pd.DataFrame({'iso3': iso3, 'date': pd.to_datetime(end_days, unit='D').date})
+    for time_type in TIME_RANGE:
+        fit = fits[time_type]
+        # no values from windows with a negative doubling time
+        valid = ~(fit['doubling_time_fit'].values < 0)
+        suffix = '' if time_type == 'mid' else f'_{time_type}_window'
+        output_df[f'pc_growth_rate{suffix}'] = np.where(valid, fit['growth_rate'].values * 100, np.nan)
+        output_df[f'doubling_time{suffix}'] = np.where(valid, fit['doubling_time_fit'].values, np.nan)
+    return output_df[~(fits['mid']['doubling_time_fit'].values < 0)]
+
+def get_PRK_row():
+    return pd.DataFrame({'iso3': ['PRK'], 'date': [datetime.datetime.today()], 'pc_growth_rate': [0.0]})
+
+def format_doubling_rates(output_df):
+    output_df = output_df.copy()
     output_df['date'] = output_df['date'].apply(lambda x: x.strftime('%Y-%m-%d'))
-    output_df.groupby('iso3').apply(lambda x: x.to_dict('r')).to_json('hrp_covid_doubling_rates.json', orient='index', indent=2)
-    output_df.to_excel('hrp_covid_doubling_rates.xlsx')
-
-    # print(output_df)
-    plt.show()
-
-def plot_mid_curve(axis,x,iwindow,df_date,func,popt,iso3):
-    axis.plot(x.index[0], df_date['CumCase'].iloc[0], 'ko')
-    axis.plot(x.index, func(x, *popt), 'r-', label=f"{iso3} - Fitted Curve", alpha=0.2)
-    if iwindow == 0:
-        axis.plot(x.index, df_date['CumCase'], 'ko', label=f"{iso3} - Original Data")
-        axis.legend()
-    # axis.set_xticks([])
-
-def plot_original_data(axis,df_country,iso3):
-    axis.plot(df_country.index, df_country['CumCase'], 'ko', label=f"{iso3} - Original Data")
-    axis.legend()
-
-def plt_min_max_curves(axis,x,iwindow,func,popt,iso3):
-    # print(x.index)
-    axis.plot(x.index, func(x, *popt), 'y-', label=f"{iso3} - Fitted Curve", alpha=0.2)
-
-def get_df_date(df_country, date, time_range):
-    # TODO: fill in date gaps with repeated values
-    df = df_country.copy()
-    df.loc[:,'day_fit']=df['date_epicrv']-date+datetime.timedelta(days=time_range)
-    df.loc[:,'day_fit']=df['day_fit'].dt.days
-    df = df[(df['day_fit'] > 0) & (df['day_fit'] <= time_range)]
-    return df
+    return output_df
+
+def save_doubling_rates(output_df, compact_json=False, gzip_json=False):
+    # Add PRK
+    output_df=pd.concat([output_df, get_PRK_row()], ignore_index=True)
+    return export_table(format_doubling_rates(output_df), OUTPUT_FILENAME, 'iso3', compact=compact_json,
+                        compress=gzip_json)
+
+def save_doubling_rates_stream(fit_pieces, compact_json=False, gzip_json=False, diagnostics=True):
+    # The rows of every country written as soon as its fits are complete, latest date
+    # first as in save_doubling_rates. The countries come in the order of the input
+    # and H63 last, as it is only known once the whole input is read.
+    with contextlib.ExitStack() as exit_stack:
+        writer = exit_stack.enter_context(TableStreamWriter(OUTPUT_FILENAME, 'iso3', compact=compact_json,
+                                                            compress=gzip_json))
+        if diagnostics:
+            diagnostics_writer = exit_stack.enter_context(TableStreamWriter(
+                DIAGNOSTICS_FILENAME, 'iso3', compact=compact_json, compress=gzip_json, xlsx=False))
+        iso3_written = set()
+        for iso3, end_days, fits in merge_country_fits(fit_pieces):
+            with profile_stage('export'):
+                iso3_written.add(iso3)
+                writer.append(format_doubling_rates(get_window_rates(iso3, end_days, fits)))
+                if diagnostics:
+                    diagnostics_writer.append(get_diagnostics([iso3], [(None, end_days, fits)]))
+        # Add PRK, unless it has values of its own
+        if 'PRK' not in iso3_written:
+            writer.append(format_doubling_rates(get_PRK_row()))
+    # the state of the incremental mode is not kept, it would not match this output
+    state_filename = get_state_filename(writer.filenames[0])
+    if os.path.exists(state_filename):
+        os.remove(state_filename)
+    print(f'Saved {writer.nrows} doubling rates to "{writer.filenames[0]}"')
+    return writer.filenames
+
+def save_diagnostics(HRP_iso3, country_fits, compact_json=False, gzip_json=False):
+    return export_table(get_diagnostics(HRP_iso3, country_fits), DIAGNOSTICS_FILENAME, 'iso3',
+                        compact=compact_json, compress=gzip_json, xlsx=False)
+
+def plot_doubling_rates(HRP_iso3, df_countries, country_fits, plots_dir=PLOTS_DIR, plot_format='png', workers=1):
+    panels = [(iso3, (df_country[['date_epicrv','CumCase']], fits, TIME_RANGE))
+              for iso3, df_country, (days, end_days, fits) in zip(HRP_iso3, df_countries, country_fits)]
+    return render_panels(plot_country_fits, panels, output_dir=plots_dir, name='doubling_rate',
+                         plot_format=plot_format, workers=workers)
+
+def fit_country(df_country, nwindows, iso3=None):
+    # Fit the latest nwindows windows of the country at once
+    with profile_stage('fit_country', iso3):
+        days = get_day_numbers(df_country['date_epicrv'])
+        values = df_country['CumCase'].values
+        end_days = days[::-1][:nwindows]
+        # gap filled daily series, shared by the time ranges
+        dense_series = get_dense_series(days, values)
+        fits = {time_type: fit_windows(days, values, end_days, time_range, dense_series)
+                for time_type, time_range in TIME_RANGE.items()}
+    return days, end_days, fits
 
-def func(x, p0, beta):
-    return p0 * np.exp(x*beta)
+def get_diagnostics(HRP_iso3, country_fits):
+    # How well every window fitted in this run went, one row per window and time range
+    df_diagnostics = []
+    for iso3, (days, end_days, fits) in zip(HRP_iso3, country_fits):
+        dates = pd.to_datetime(end_days, unit='D').strftime('%Y-%m-%d')
+        for time_type, df_fit in fits.items():
+            df = df_fit[DIAGNOSTIC_COLUMNS].copy()
+            df.insert(0, 'iso3', iso3)
+            df.insert(1, 'date', dates)
+            df.insert(2, 'time_range', time_type)
+            df_diagnostics.append(df)
+    return pd.concat(df_diagnostics, ignore_index=True)
 
 def get_WHO_data(HRP_iso3):
-    df=pd.read_csv(f'{DIR_PATH}/{WHO_COVID_FILENAME}')
     # get only HRP countries
-    df = df.loc[df['ISO_3_CODE'].isin(HRP_iso3),:]
-    df['date_epicrv']=pd.to_datetime(df['date_epicrv']).dt.date
-    df=df[['date_epicrv','ISO_3_CODE','CumCase']]
+    with profile_stage('ingest'):
+        df=get_who_data(f'{DIR_PATH}/{WHO_COVID_FILENAME}', HRP_iso3)
+        df['date_epicrv']=df['date_epicrv'].dt.date
+        df=df[['date_epicrv','ISO_3_CODE','CumCase']]
 
     # adding global by date
-    df_all=df.groupby('date_epicrv').sum()
-    df_all['ISO_3_CODE']='H63'
-    df_all=df_all.reset_index()
+    with profile_stage('aggregate'):
+        df_all=get_group_rollup(HRP_iso3, custom_groups=False, regions=False).rollup_series(df, ['CumCase'])
     HRP_iso3.insert(0,'H63')
-    df=df.append(df_all)
+    df=pd.concat([df, df_all], ignore_index=True)
     return df
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    args = parse_args()
+    with profile_run(args.profile, args.profile_stats):
+        main(workers=args.workers, incremental=args.incremental, plots=not args.no_plots,
+             plots_dir=args.plots_dir, plot_format=args.plot_format, compact_json=args.compact_json,
+             gzip_json=args.gzip_json, diagnostics=not args.no_diagnostics, stream=args.stream,
+             chunk_size=args.chunk_size)
\ No newline at end of file
@@ -1,17 +1,28 @@
 import argparse
+import numpy as np
 import pandas as pd
 import requests
-import matplotlib.pyplot as plt
 import os
-import yaml
-import math
+
+from utils.countries import get_country_list
+from utils.download import DownloadError, count_csv_rows, download_url, validate_csv
+from utils.export import TableStreamWriter, add_json_arguments, export_table
+from utils.parallel import map_countries
+from utils.plotting import PLOTS_DIR, add_plot_arguments, plot_country_trend, render_panels
+from utils.population import add_population_arguments, get_population_store, get_population_year_from_args
+from utils.profiling import add_profile_arguments, profile_run, profile_stage
+from utils.rollup import get_group_rollup
+from utils.streaming import STREAM_CHUNK_SIZE, GroupStream, StreamingRollup, WeeklyState, read_who_chunks, \
+    split_runs
+from utils.weekly import WEEK_ANCHORS, aggregate_weekly
+from utils.who_data import WHO_COLUMNS, WHO_NUMERIC_COLUMNS, get_who_data
 
 # filename for shapefile and WHO input dataset
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 WHO_COVID_FILENAME='WHO_data/Data_ WHO Coronavirus Covid-19 Cases and Deaths - WHO-COVID-19-global-data.csv'
 WHO_COVID_URL='https://docs.google.com/spreadsheets/d/e/2PACX-1vSe-8lf6l_ShJHvd126J-jGti992SUbNLu-kmJfx1IRkvma_r4DHi0bwEW89opArs8ZkSY5G2-Bc1yT/pub?gid=0&single=true&output=csv'
-POPULATION_FILENAME='Population_data/API_SP.POP.TOTL_DS2_en_excel_v2_1121005.xls'
-H25_iso3=['AFG','BDI','BFA','CAF','CMR','COD','COL','ETH','HTI','IRQ','LBY','MLI','MMR','NER','NGA','PSE','SDN','SOM','SSD','SYR','TCD','UKR','VEN','YEM','ZWE']
+POPULATION_YEAR=2018
+OUTPUT_FILENAME='hrp_covid_weekly_trend'
 
 MIN_CUMULATIVE_CASES = 100
 
@@ -19,58 +30,104 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--download-covid', action='store_true',
                         help='Download the COVID-19 data')
-    return parser.parse_args()
-
-def download_url(url, save_path, chunk_size=128):
-    r = requests.get(url, stream=True)
-    with open(save_path, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=chunk_size):
-            fd.write(chunk)
-    print(f'Downloaded "{url}" to "{save_path}"')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to resample the countries')
+    add_population_arguments(parser, POPULATION_YEAR)
+    parser.add_argument('--week-anchor', default='W-SUN', choices=WEEK_ANCHORS,
+                        help='Weeks ending on the given day (W-SUN is the default), or ISO weeks')
+    parser.add_argument('--no-plots', action='store_true',
+                        help='Do not draw the weekly trends (matplotlib is then not needed)')
+    add_plot_arguments(parser)
+    add_json_arguments(parser)
+    parser.add_argument('--stream', action='store_true',
+                        help='Read the WHO data in chunks and write the output as it comes, in bounded memory; '
+                             'the rows have to be grouped by country in date order. The countries are written '
+                             'in the order of the input and the groups (H63, H25, regions) last. No plots are drawn')
+    parser.add_argument('--chunk-size', type=int, default=STREAM_CHUNK_SIZE,
+                        help='Rows of the WHO data read at a time with --stream (default %(default)s)')
+    add_profile_arguments(parser, f'{OUTPUT_FILENAME}.profile.json')
+    args = parser.parse_args()
+    args.population_year = get_population_year_from_args(parser, args)
+    return args
 
 def get_covid_data(url, save_path):
     # download covid data from HDX
     print(f'Getting upadated COVID data from WHO')
+    # the new file should have the columns we use, with a count on every row (they
+    # are read as integers), and not be shorter than the current one
+    min_rows = count_csv_rows(save_path) if os.path.exists(save_path) else None
     try:
-        download_url(url, save_path)
-    except Exception:
-        print(f'Cannot download COVID file from from HDX')
-
-def main(download_covid=False):
+        download_url(url, save_path,
+                     validate=lambda filename: validate_csv(filename, WHO_COLUMNS, min_rows, WHO_NUMERIC_COLUMNS))
+    except (DownloadError, requests.RequestException, OSError) as err:
+        print(f'Cannot download COVID file from from HDX: {err}')
+
+def main(download_covid=False, workers=1, week_anchor='W-SUN', population_year=POPULATION_YEAR, plots=True,
+         plots_dir=PLOTS_DIR, plot_format='png', compact_json=False, gzip_json=False, stream=False,
+         chunk_size=STREAM_CHUNK_SIZE):
     # Read in list of countries
-    with open('countries/admins.yaml', 'r') as stream:
-        country_list = yaml.safe_load(stream)['admin_info']
-    H63_iso3 = sorted(list(set([country.get('alpha_3', None) for country in country_list])))
+    with profile_stage('countries'):
+        H63_iso3 = get_country_list()
     
     # Download latest covid file tiles and read them in
     if download_covid:
-        get_covid_data(WHO_COVID_URL,f'{DIR_PATH}/{WHO_COVID_FILENAME}')
+        with profile_stage('download'):
+            get_covid_data(WHO_COVID_URL,f'{DIR_PATH}/{WHO_COVID_FILENAME}')
+    with profile_stage('population'):
+        df_pop=get_pop_data(H63_iso3, population_year)
+    if stream:
+        # weeks written as soon as they are complete
+        save_weekly_trend_stream(get_weekly_trend_stream(H63_iso3, df_pop, week_anchor, chunk_size),
+                                 compact_json, gzip_json)
+        return
     # get WHO data and calculate sum as 'H63'
     df_WHO=get_WHO_data(H63_iso3)
-    
-    # get weekly new cases
-    new_w=df_WHO.groupby(['ISO_3_CODE']).resample('W', on='date_epicrv').sum()[['NewCase','NewDeath']]
-    cumulative_w=df_WHO.groupby(['ISO_3_CODE']).resample('W', on='date_epicrv').min()[['CumCase','CumDeath']]
-    ndays_w=df_WHO.groupby(['ISO_3_CODE']).resample('W', on='date_epicrv').count()['NewCase']
-    ndays_w=ndays_w.rename('ndays')
-
-    output_df=pd.merge(left=new_w,right=cumulative_w,left_index=True,right_index=True,how='inner')
-    output_df=pd.merge(left=output_df,right=ndays_w,left_index=True,right_index=True,how='inner')
-    output_df=output_df[output_df['ndays']==7]
-    output_df=output_df.reset_index()
-
-    output_df['NewCase_PercentChange'] = output_df.groupby('ISO_3_CODE')['NewCase'].pct_change()
-    output_df['NewDeath_PercentChange'] = output_df.groupby('ISO_3_CODE')['NewDeath'].pct_change()
-    # For percent change, if the diff is actually 0, change nan to 0
-    output_df['diff_cases'] = output_df.groupby('ISO_3_CODE')['NewCase'].diff()
-    output_df.loc[(output_df['NewCase_PercentChange'].isna()) & (output_df['diff_cases']==0), 'NewCase_PercentChange'] = 0.0
-    output_df['diff_deaths'] = output_df.groupby('ISO_3_CODE')['NewDeath'].diff()
-    output_df.loc[(output_df['NewDeath_PercentChange'].isna()) & (output_df['diff_deaths']==0), 'NewDeath_PercentChange'] = 0.0
-
+    output_df=get_weekly_trend(df_WHO, df_pop, week_anchor, workers)
+
+    # Save plots, one file per country
+    if plots:
+        with profile_stage('plots'):
+            plot_weekly_trend(output_df, plots_dir, plot_format, workers)
+
+    # Save as JSON and Excel
+    with profile_stage('export'):
+        save_weekly_trend(output_df, compact_json, gzip_json)
+
+
+def get_weekly_trend(df_WHO, df_pop, week_anchor='W-SUN', workers=1):
+    # get weekly new cases and their week over week changes, split in batches of countries
+    iso3_list = sorted(set(df_WHO['ISO_3_CODE']))
+    iso3_batches = [list(batch) for batch in np.array_split(iso3_list, max(workers, 1)) if len(batch)]
+    df_batches = [df_WHO.loc[df_WHO['ISO_3_CODE'].isin(batch), ['ISO_3_CODE','date_epicrv','NewCase','NewDeath','CumCase','CumDeath']]
+                  for batch in iso3_batches]
+    with profile_stage('weekly'):
+        output_df=pd.concat(map_countries(aggregate_weekly, df_batches, [week_anchor] * len(df_batches), workers=workers),
+                            ignore_index=True)
+    return add_weekly_rates(output_df, df_pop)
+
+
+def get_weekly_trend_stream(H63_iso3, df_pop, week_anchor='W-SUN', chunk_size=STREAM_CHUNK_SIZE):
+    # get_weekly_trend in pieces, one per chunk of the WHO data (see utils/streaming.py),
+    # the countries first and then H63, H25 and the regions from their sums by date
+    rollup = StreamingRollup(get_group_rollup(H63_iso3), WHO_NUMERIC_COLUMNS)
+    country_stream = GroupStream(lambda iso3: WeeklyState(week_anchor))
+    for df in read_who_chunks(f'{DIR_PATH}/{WHO_COVID_FILENAME}', H63_iso3, chunk_size):
+        with profile_stage('aggregate'):
+            rollup.add(df)
+        with profile_stage('weekly'):
+            weeks = [output_df for _, output_df in country_stream.update(df)]
+        if weeks:
+            yield add_weekly_rates(pd.concat(weeks, ignore_index=True), df_pop)
+    weeks = [output_df for _, output_df in country_stream.finish()]
+    with profile_stage('weekly'):
+        weeks += [aggregate_weekly(rows, week_anchor) for _, rows in split_runs(rollup.get_series())]
+    if weeks:
+        yield add_weekly_rates(pd.concat(weeks, ignore_index=True), df_pop)
+
+
+def add_weekly_rates(output_df, df_pop):
     output_df=output_df[output_df['CumCase']>MIN_CUMULATIVE_CASES]
 
-    df_pop=get_pop_data(H63_iso3)
-
     # Add pop to output df
     output_df = output_df.merge(df_pop, left_on='ISO_3_CODE', right_on='Country Code', how='left').drop(
         columns=['Country Code'])
@@ -81,101 +138,61 @@ def main(download_covid=False):
     output_df['weekly_new_deaths_per_ht'] = output_df['weekly_new_deaths'] / output_df['population'] * 1E5
     output_df['weekly_new_cases_pc_change'] = output_df['NewCase_PercentChange'] * 100
     output_df['weekly_new_deaths_pc_change'] = output_df['NewDeath_PercentChange'] * 100
+    return output_df
 
-    # Show plots
-    pd.plotting.register_matplotlib_converters()
-    nplots=math.sqrt(len(set(df_WHO['ISO_3_CODE'])))
-    nplots=math.ceil(nplots)
-    
-    for q in ['weekly_new_cases_per_ht', 'weekly_new_cases_pc_change','weekly_new_deaths_per_ht', 'weekly_new_deaths_pc_change']:
-        fig,axs=plt.subplots(figsize=[15,10],nrows=nplots,ncols=nplots)
-        fig.suptitle(q)
-        ifig = 0
-        for iso3, group in output_df.groupby('ISO_3_CODE'):
-            axis = axs[ifig // nplots][ifig % nplots]
-            if q in ['weekly_new_cases_pc_change','weekly_new_deaths_pc_change']:
-                idx = group[q] > 0
-                axis.bar(x=group['date_epicrv'][idx], height=group[q][idx], color='r')
-                idx = group[q] < 0
-                axis.bar(x=group['date_epicrv'][idx], height=group[q][idx], color='b')
-                axis.set_ylim(-100, 100)
-                axis.axhline(y=0, c='k')
-            else:
-                axis.plot(group['date_epicrv'], group[q])
-                #axis.set_ylim(0, output_df[q].max())
-            axis.set_title(iso3)
-            axis.set_xticks([])
-            ifig += 1
-
-    # Save as JSON
-    output_df['date_epicrv'] = output_df['date_epicrv'].apply(lambda x: x.strftime('%Y-%m-%d'))
+
+def plot_weekly_trend(output_df, plots_dir=PLOTS_DIR, plot_format='png', workers=1):
+    return render_panels(plot_country_trend, list(output_df.groupby('ISO_3_CODE')), output_dir=plots_dir,
+                         name='weekly_trend', plot_format=plot_format, workers=workers)
+
+
+def save_weekly_trend(output_df, compact_json=False, gzip_json=False):
+    return export_table(format_weekly_trend(output_df), OUTPUT_FILENAME, 'ISO_3_CODE', compact=compact_json,
+                        compress=gzip_json)
+
+
+def save_weekly_trend_stream(output_dfs, compact_json=False, gzip_json=False):
+    # the pieces of the output written one after the other, countries in the order of the input
+    with TableStreamWriter(OUTPUT_FILENAME, 'ISO_3_CODE', compact=compact_json, compress=gzip_json) as writer:
+        for output_df in output_dfs:
+            with profile_stage('export'):
+                writer.append(format_weekly_trend(output_df))
+    print(f'Saved {writer.nrows} weeks to "{writer.filenames[0]}"')
+    return writer.filenames
+
+
+def format_weekly_trend(output_df):
     output_df = output_df.drop(['NewCase_PercentChange','NewDeath_PercentChange', 'ndays', 'diff_cases','diff_deaths'], axis=1)
-    output_df.groupby('ISO_3_CODE').apply(lambda x: x.to_dict('r')).to_json(
-        'hrp_covid_weekly_trend.json', orient='index', indent=2)
-    output_df.to_excel('hrp_covid_weekly_trend.xlsx')
-    # plt.show()
+    output_df['date_epicrv'] = output_df['date_epicrv'].apply(lambda x: x.strftime('%Y-%m-%d'))
+    return output_df
 
 
 def get_WHO_data(H63_iso3):
-    df=pd.read_csv(f'{DIR_PATH}/{WHO_COVID_FILENAME}')
     # get only HRP countries
-    df = df.loc[df['ISO_3_CODE'].isin(H63_iso3),:]
-    df['date_epicrv']=pd.to_datetime(df['date_epicrv'])
-    df=df[['date_epicrv','ISO_3_CODE','CumCase','NewCase','NewDeath','CumDeath']]
-
-    # adding global by date
-    df_H63=df.groupby('date_epicrv').sum()
-    df_H63['ISO_3_CODE']='H63'
-    df_H63=df_H63.reset_index()
-
-    # adding global H25 by date
-    df_H25=df.loc[df['ISO_3_CODE'].isin(H25_iso3),:]
-    df_H25=df_H25.groupby('date_epicrv').sum()
-    df_H25['ISO_3_CODE']='H25'
-    df_H25=df_H25.reset_index()
-
-    # adding regional by date
-    dict_regions=get_dict_regions(H63_iso3)
-    df=pd.merge(left=df,right=dict_regions,left_on='ISO_3_CODE',right_on='ISO3',how='left')
-    df=df.drop(labels='ISO3',axis='columns')
-    df_regional=df.groupby(['date_epicrv','Regional_office']).sum().reset_index()
-    df_regional=df_regional.rename(columns={'Regional_office':'ISO_3_CODE'})    
-
-    df=df.append(df_H63)
-    df=df.append(df_H25)
-    df=df.append(df_regional)
+    with profile_stage('ingest'):
+        df=get_who_data(f'{DIR_PATH}/{WHO_COVID_FILENAME}', H63_iso3)
+        df=df[['date_epicrv','ISO_3_CODE','CumCase','NewCase','NewDeath','CumDeath']]
+
+    # adding global (H63), H25 and regional by date
+    with profile_stage('aggregate'):
+        df_groups=get_group_rollup(H63_iso3).rollup_series(df, WHO_NUMERIC_COLUMNS)
+    df=pd.concat([df, df_groups], ignore_index=True)
     return df
 
-def get_dict_regions(H63_iso3):
-    dict_regions=pd.read_csv('countries/tbl_regcov_2020_ocha.csv')
-    dict_regions=dict_regions[['ISO3','Regional_office']]
-    dict_regions=dict_regions[dict_regions['ISO3'].isin(H63_iso3)]
-    dict_regions=dict_regions.drop_duplicates(subset='ISO3')
-    return dict_regions
-
 
-def get_pop_data(H63_iso3):
+def get_pop_data(H63_iso3, year=POPULATION_YEAR):
     # Read in pop
-    df_pop=pd.read_excel(POPULATION_FILENAME,sheet_name='Data',header=1,skiprows=[0,1],usecols='B,BK').rename(
-        columns={'2018': 'population'})
-    # Add H63
-    df_pop = df_pop.append({'Country Code': 'H63',
-                            'population':  df_pop.loc[df_pop['Country Code'].isin(H63_iso3), 'population'].sum()},
-                           ignore_index=True)
-    # Add H25
-    df_pop = df_pop.append({'Country Code': 'H25',
-                            'population':  df_pop.loc[df_pop['Country Code'].isin(H25_iso3), 'population'].sum()},
-                           ignore_index=True)
-    # add regions
-    dict_regions=get_dict_regions(H63_iso3)
-    df=pd.merge(left=df_pop,right=dict_regions,left_on='Country Code',right_on='ISO3',how='left')
-    df=df.drop(labels='ISO3',axis='columns')
-    df_regional=df.groupby(['Regional_office']).sum().reset_index()
-    df_regional=df_regional.rename(columns={'Regional_office':'Country Code'})
-    df_pop=df_pop.append(df_regional)
+    population_store=get_population_store()
+    # Add H63, H25 and regions
+    df_pop=pd.concat([population_store.get_series(year),
+                      population_store.get_group_totals(get_group_rollup(H63_iso3), year)])
+    df_pop=df_pop.rename_axis('Country Code').reset_index()
 
     return df_pop
 
 if __name__ == '__main__':
     args = parse_args()
-    main(download_covid=args.download_covid)
+    with profile_run(args.profile, args.profile_stats):
+        main(download_covid=args.download_covid, workers=args.workers, week_anchor=args.week_anchor,
+             population_year=args.population_year, plots=not args.no_plots, plots_dir=args.plots_dir, plot_format=args.plot_format,
+             compact_json=args.compact_json, gzip_json=args.gzip_json, stream=args.stream, chunk_size=args.chunk_size)
@@ -1,65 +1,86 @@
-import pandas as pd
+import argparse
 import os
-import matplotlib.pyplot as plt
-import geopandas as gpd
 
+import pandas as pd
 
-# filename for shapefile and WHO input dataset
-DIR_PATH = os.path.dirname(os.path.realpath(__file__))
-FILENAME_SHP = 'ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+from utils.countries import get_country_list
+from utils.export import read_json
+from utils.maps import get_map_layer, render_map, render_map_frames
+from utils.plotting import PLOTS_DIR, add_plot_arguments, get_pyplot
+from utils.profiling import add_profile_arguments, profile_run, profile_stage
 
-iso_codes=['SDN','SSD','AFG','HTI','COD']
+# Maps and time series of the output of calculate_daily_growth_rate.py
+INPUT_FILENAME = 'hrp_covid_doubling_rates.json'
+ISO_CODES = ['SDN', 'SSD', 'AFG', 'HTI', 'COD']
 
-output_df=pd.read_excel('hrp_covid_doubling_rates.xlsx')
-world_boundaries=gpd.read_file('{}/{}'.format(DIR_PATH,FILENAME_SHP))
 
-output_df_geo=world_boundaries.merge(output_df.drop_duplicates(keep='first'),
-                                        left_on='ADM0_A3',right_on='iso3',how='left')
-# plotting map
-_, ax_map_gr = plt.subplots(figsize=[15,10],nrows=1,ncols=1)
-output_df_geo.plot(column='pc_growth_rate',cmap='OrRd',ax=ax_map_gr, legend=True,legend_kwds={'label': "Daily Growth Rate",'orientation': "horizontal"})
-output_df_geo.boundary.plot(ax=ax_map_gr,lw=0.5)
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', default=INPUT_FILENAME,
+                        help='Doubling rates to plot, JSON (optionally .gz) or Excel (default %(default)s)')
+    parser.add_argument('--countries', nargs='+', default=ISO_CODES, help='Countries of the time series plots')
+    parser.add_argument('--frames', action='store_true',
+                        help='Also draw the growth rate map of every date, e.g. for an animation')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes used to draw the frames')
+    add_plot_arguments(parser)
+    add_profile_arguments(parser, 'plt_growth_rate.profile.json')
+    return parser.parse_args()
 
-_, ax_map_dt = plt.subplots(figsize=[15,10],nrows=1,ncols=1)
-output_df_geo.plot(column='doubling_time',cmap='OrRd_r',scheme='quantiles',ax=ax_map_dt, legend=True)
-output_df_geo.boundary.plot(ax=ax_map_dt,lw=0.5)
+def main(input_filename=INPUT_FILENAME, iso_codes=ISO_CODES, frames=False, workers=1, plots_dir=PLOTS_DIR,
+         plot_format='png'):
+    with profile_stage('ingest'):
+        output_df = read_doubling_rates(input_filename)
+    # simplified shapes of the HRP countries, from the cache after the first run
+    with profile_stage('geometry'):
+        layer = get_map_layer(get_country_list())
 
-output_df=output_df[output_df['iso3'].isin(iso_codes)]
-output_df['date']=pd.to_datetime(output_df['date']).dt.date
-output_df.sort_values(by='date',ascending=True)
-output_df=output_df.set_index('date')
+    # maps of the latest values
+    with profile_stage('maps'):
+        render_map(layer, output_df, 'pc_growth_rate', plots_dir, 'growth_rate_map', plot_format,
+                   label='Daily Growth Rate')
+        render_map(layer, output_df, 'doubling_time', plots_dir, 'doubling_time_map', plot_format,
+                   cmap='OrRd_r', scheme='quantiles')
+    if frames:
+        with profile_stage('frames'):
+            render_map_frames(layer, get_fitted_dates(output_df), 'pc_growth_rate', plots_dir, 'growth_rate_frame',
+                              plot_format, workers, label='Daily Growth Rate')
 
-_, ax_gr = plt.subplots(figsize=[15,10],nrows=1,ncols=1)
-for name, group in output_df.groupby('iso3'):
-    group['pc_growth_rate'].plot(ax=ax_gr,label=name)
-    color=plt.gca().lines[-1].get_color()
-    ax_gr.fill_between(group.index,
-                       group['pc_growth_rate'],
-                       group['pc_growth_rate_min_window'],
-                       alpha=0.1,
-                       color=color)
-    ax_gr.fill_between(group.index,
-                       group['pc_growth_rate'],
-                       group['pc_growth_rate_max_window'],
-                       alpha=0.1,
-                       color=color)
+    # time series of a few countries with the bands of the other time ranges
+    with profile_stage('plots'):
+        output_df = output_df[output_df['iso3'].isin(iso_codes)].sort_values(by='date')
+        for column in ['pc_growth_rate', 'doubling_time']:
+            plot_country_series(output_df, column, os.path.join(plots_dir, f'{column}_series.{plot_format}'))
 
-_, ax_dt = plt.subplots(figsize=[15,10],nrows=1,ncols=1)
-for name, group in output_df.groupby('iso3'):
-    group['doubling_time'].plot(ax=ax_dt,label=name)
-    color=plt.gca().lines[-1].get_color()
-    ax_dt.fill_between(group.index,
-                       group['doubling_time'],
-                       group['doubling_time_min_window'],
-                       alpha=0.1,
-                       color=color)
-    ax_dt.fill_between(group.index,
-                       group['doubling_time'],
-                       group['doubling_time_max_window'],
-                       alpha=0.1,
-                       color=color)
+def read_doubling_rates(filename):
+    if filename.endswith('.xlsx'):
+        df = pd.read_excel(filename)
+    else:
+        df = pd.DataFrame([row for rows in read_json(filename).values() for row in rows])
+    df['date'] = pd.to_datetime(df['date']).dt.date
+    return df
 
-plt.legend()
+def get_fitted_dates(output_df):
+    # the rows up to the latest date of the fits: the PRK placeholder row is dated
+    # the day the output was written, which would add a frame of its own
+    latest_date = output_df.loc[output_df['pc_growth_rate_min_window'].notna(), 'date'].max()
+    return output_df[output_df['date'] <= latest_date]
 
+def plot_country_series(output_df, column, filename):
+    plt = get_pyplot()
+    fig, axis = plt.subplots(figsize=[15, 10])
+    for name, group in output_df.groupby('iso3'):
+        line, = axis.plot(group['date'], group[column], label=name)
+        for time_type in ['min', 'max']:
+            axis.fill_between(group['date'], group[column], group[f'{column}_{time_type}_window'],
+                              alpha=0.1, color=line.get_color())
+    axis.set_title(column)
+    axis.legend()
+    fig.autofmt_xdate()
+    fig.savefig(filename)
+    plt.close(fig)
 
-plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    with profile_run(args.profile, args.profile_stats):
+        main(input_filename=args.input, iso_codes=args.countries, frames=args.frames, workers=args.workers,
+             plots_dir=args.plots_dir, plot_format=args.plot_format)
@@ -0,0 +1,133 @@
+import argparse
+import datetime
+import os
+
+import pandas as pd
+
+from calculate_daily_growth_rate import get_doubling_rates, plot_doubling_rates, save_diagnostics, save_doubling_rates
+from calculate_GHO_increase import PERIODS, save_period_increase
+from calculate_weekly_increase import POPULATION_YEAR, WHO_COVID_URL, get_covid_data, get_pop_data, \
+    get_weekly_trend, plot_weekly_trend, save_weekly_trend
+from utils.countries import ALL_COUNTRIES_GROUP, COUNTRIES_FILENAME, DIR_PATH, REGIONS_FILENAME, \
+    get_country_list, get_group_definitions
+from utils.export import add_json_arguments
+from utils.periods import add_period_arguments, compare_periods, get_periods_from_args
+from utils.pipeline import Pipeline, Stage
+from utils.plotting import PLOTS_DIR, add_plot_arguments
+from utils.population import POPULATION_FILENAME, add_population_arguments, get_population_year_from_args
+from utils.profiling import add_profile_arguments, profile_run
+from utils.rollup import get_group_rollup
+from utils.weekly import WEEK_ANCHORS
+from utils.who_data import WHO_NUMERIC_COLUMNS, get_who_data
+
+# All the HDX outputs from a single read of the inputs: the WHO data is ingested
+# and aggregated once, then the weekly trend, the doubling rates and the period
+# increase are computed from it and exported. Each stage is cached on disk (see
+# utils/pipeline.py), so a run only recomputes what is downstream of a change.
+WHO_COVID_FILENAME = 'WHO_data/Data_ WHO Coronavirus Covid-19 Cases and Deaths - WHO-COVID-19-global-data.csv'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--download-covid', action='store_true', help='Download the COVID-19 data first')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used by the stages that work country by country')
+    parser.add_argument('-j', '--jobs', type=int, default=3, help='Number of stages run at the same time')
+    parser.add_argument('-f', '--force', action='store_true', help='Run every stage, ignoring the cache')
+    parser.add_argument('--week-anchor', default='W-SUN', choices=WEEK_ANCHORS,
+                        help='Weeks ending on the given day (W-SUN is the default), or ISO weeks')
+    add_population_arguments(parser, POPULATION_YEAR)
+    add_period_arguments(parser)
+    parser.add_argument('--regions', action='store_true', help='Also compare the regional groups over the periods')
+    parser.add_argument('--no-plots', action='store_true', help='Do not draw the plots')
+    add_plot_arguments(parser)
+    add_json_arguments(parser)
+    parser.add_argument('--no-diagnostics', action='store_true', help='Do not save the fit diagnostics')
+    add_profile_arguments(parser, 'pipeline.profile.json')
+    args = parser.parse_args()
+    args.population_year = get_population_year_from_args(parser, args)
+    args.periods = get_periods_from_args(parser, args, PERIODS)
+    return args
+
+
+def ingest(H63_iso3):
+    df = get_who_data(os.path.join(DIR_PATH, WHO_COVID_FILENAME), H63_iso3)
+    return df[['date_epicrv', 'ISO_3_CODE', 'CumCase', 'NewCase', 'NewDeath', 'CumDeath']]
+
+
+def aggregate(H63_iso3, df_WHO):
+    # countries followed by the H63, H25 and regional sums by date
+    df_groups = get_group_rollup(H63_iso3).rollup_series(df_WHO, WHO_NUMERIC_COLUMNS)
+    return pd.concat([df_WHO, df_groups], ignore_index=True)
+
+
+def get_doubling(H63_iso3, df_WHO, workers=1):
+    # fit the countries and H63 only, on dates
+    HRP_iso3 = [ALL_COUNTRIES_GROUP] + H63_iso3
+    df = df_WHO.loc[df_WHO['ISO_3_CODE'].isin(HRP_iso3), ['date_epicrv', 'ISO_3_CODE', 'CumCase']]
+    df['date_epicrv'] = df['date_epicrv'].dt.date
+    output_df, df_countries, country_fits, _ = get_doubling_rates(df, HRP_iso3, workers)
+    return {'iso3': HRP_iso3, 'output': output_df, 'countries': df_countries, 'fits': country_fits}
+
+
+def get_period_increase(H63_iso3, df_WHO, periods, regions=False):
+    codes = H63_iso3 + list(get_group_definitions(H63_iso3, regions=regions))
+    return compare_periods(df_WHO[df_WHO['ISO_3_CODE'].isin(codes)], periods)
+
+
+def export_doubling(doubling, compact_json=False, gzip_json=False, diagnostics=True, date=None):
+    # date is only there to export again every day, the PRK row is dated today
+    filenames = save_doubling_rates(doubling['output'], compact_json, gzip_json)
+    if diagnostics:
+        filenames += save_diagnostics(doubling['iso3'], doubling['fits'], compact_json, gzip_json)
+    return filenames
+
+
+def plot_doubling(doubling, plots_dir=PLOTS_DIR, plot_format='png', workers=1):
+    return plot_doubling_rates(doubling['iso3'], doubling['countries'], doubling['fits'], plots_dir,
+                               plot_format, workers)
+
+
+def get_stages(week_anchor='W-SUN', population_year=POPULATION_YEAR, periods=PERIODS, regions=False,
+               plots=True, plots_dir=PLOTS_DIR, plot_format='png', compact_json=False, gzip_json=False,
+               diagnostics=True, workers=1):
+    # ingest -> aggregate -> {weekly trend, doubling rates, period increase} -> export / plots
+    json_options = {'compact_json': compact_json, 'gzip_json': gzip_json}
+    stages = [
+        Stage('countries', get_country_list,
+              sources=[os.path.join(DIR_PATH, COUNTRIES_FILENAME), os.path.join(DIR_PATH, REGIONS_FILENAME)]),
+        Stage('ingest', ingest, ['countries'], sources=[os.path.join(DIR_PATH, WHO_COVID_FILENAME)]),
+        Stage('aggregate', aggregate, ['countries', 'ingest']),
+        Stage('population', get_pop_data, ['countries'], {'year': population_year},
+              sources=[os.path.join(DIR_PATH, POPULATION_FILENAME)]),
+        Stage('weekly', get_weekly_trend, ['aggregate', 'population'], {'week_anchor': week_anchor},
+              {'workers': workers}),
+        Stage('doubling', get_doubling, ['countries', 'aggregate'], options={'workers': workers}),
+        Stage('period', get_period_increase, ['countries', 'aggregate'], {'periods': periods, 'regions': regions}),
+        Stage('export_weekly', save_weekly_trend, ['weekly'], json_options, files=True),
+        Stage('export_doubling', export_doubling, ['doubling'],
+              dict(json_options, diagnostics=diagnostics, date=datetime.date.today()), files=True),
+        Stage('export_period', save_period_increase, ['period'], files=True),
+    ]
+    if plots:
+        plot_options = {'plots_dir': plots_dir, 'plot_format': plot_format}
+        stages += [
+            Stage('plots_weekly', plot_weekly_trend, ['weekly'], plot_options, {'workers': workers}, files=True),
+            Stage('plots_doubling', plot_doubling, ['doubling'], plot_options, {'workers': workers}, files=True),
+        ]
+    return stages
+
+
+def main(download_covid=False, workers=1, jobs=3, force=False, **stage_args):
+    if download_covid:
+        get_covid_data(WHO_COVID_URL, os.path.join(DIR_PATH, WHO_COVID_FILENAME))
+    Pipeline(get_stages(workers=workers, **stage_args), force=force).run(jobs)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with profile_run(args.profile, args.profile_stats):
+        main(download_covid=args.download_covid, workers=args.workers, jobs=args.jobs, force=args.force,
+             week_anchor=args.week_anchor, population_year=args.population_year, periods=args.periods,
+             regions=args.regions, plots=not args.no_plots, plots_dir=args.plots_dir, plot_format=args.plot_format,
+             compact_json=args.compact_json, gzip_json=args.gzip_json, diagnostics=not args.no_diagnostics)
@@ -0,0 +1,143 @@
+import http.server
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from utils.download import DownloadError, download_url, validate_csv
+
+DATA = b'ISO_3_CODE,CumCase\n' + b''.join(f'C{i:02d},{i}\n'.encode() for i in range(100))
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    # Serves server.data with server.etag, supporting If-None-Match, Range and
+    # If-Range. The body of the first server.cut responses stops half way.
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.errors:
+            server.errors -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body, start = server.data, 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == server.etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if server.cut:
+            server.cut -= 1
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+        self.server.data, self.server.etag = DATA, '"v1"'
+        self.server.errors, self.server.cut, self.server.requests = 0, 0, []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/data.csv'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.save_path = os.path.join(self.tmp_dir.name, 'data.csv')
+        patcher = mock.patch('utils.download.time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def read(self):
+        with open(self.save_path, 'rb') as stream:
+            return stream.read()
+
+    def test_download(self):
+        self.assertTrue(download_url(self.url, self.save_path))
+        self.assertEqual(self.read(), DATA)
+        # permissions of a file made by open(), not the private ones of a temp file
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(self.save_path).st_mode & 0o777, 0o666 & ~umask)
+        self.assertCountEqual(os.listdir(self.tmp_dir.name), ['data.csv', 'data.csv.download.json'])
+
+    def test_not_modified(self):
+        download_url(self.url, self.save_path)
+        self.assertFalse(download_url(self.url, self.save_path))
+        self.assertEqual(self.server.requests[-1]['If-None-Match'], '"v1"')
+        self.assertEqual(self.read(), DATA)
+
+    def test_retry(self):
+        self.server.errors = 2
+        self.assertTrue(download_url(self.url, self.save_path))
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.read(), DATA)
+
+    def test_resume(self):
+        # small chunks, so that part of the cut body is written before the error
+        self.server.cut = 1
+        self.assertTrue(download_url(self.url, self.save_path, chunk_size=64))
+        resume_headers = self.server.requests[1]
+        self.assertRegex(resume_headers['Range'], r'^bytes=[1-9][0-9]*-$')
+        self.assertEqual(resume_headers['If-Range'], '"v1"')
+        self.assertEqual(self.read(), DATA)
+
+    def test_resume_changed_file(self):
+        # the file changes between the attempts: the server sends all of the new one
+        self.server.cut = 1
+        new_data = DATA.replace(b',', b';')
+        original_handler = FileHandler.do_GET
+
+        def do_GET(handler):
+            if len(self.server.requests) == 1:
+                self.server.data, self.server.etag = new_data, '"v2"'
+            original_handler(handler)
+
+        with mock.patch.object(FileHandler, 'do_GET', do_GET):
+            self.assertTrue(download_url(self.url, self.save_path, chunk_size=64))
+        self.assertEqual(self.server.requests[1]['If-Range'], '"v1"')
+        self.assertEqual(self.read(), new_data)
+
+    def test_failed_download_keeps_file(self):
+        with open(self.save_path, 'wb') as stream:
+            stream.write(b'old')
+        with self.assertRaises(DownloadError):
+            download_url(self.url, self.save_path, expected_sha256='0' * 64)
+        self.server.errors = 10
+        with self.assertRaises(DownloadError):
+            download_url(self.url, self.save_path, retries=1)
+        self.assertEqual(self.read(), b'old')
+        self.assertCountEqual(os.listdir(self.tmp_dir.name), ['data.csv'])
+
+    def test_blank_value_keeps_file(self):
+        # a row without a count is rejected before the file is replaced
+        with open(self.save_path, 'wb') as stream:
+            stream.write(b'old')
+        self.server.data = DATA.replace(b'C05,5', b'C05,')
+        validate = lambda filename: validate_csv(filename, ['ISO_3_CODE', 'CumCase'], 100, ['CumCase'])
+        with self.assertRaisesRegex(DownloadError, 'no CumCase on row 6'):
+            download_url(self.url, self.save_path, validate=validate)
+        self.assertEqual(self.read(), b'old')
+        self.server.data = DATA
+        self.assertTrue(download_url(self.url, self.save_path, validate=validate))
+
+
+if __name__ == '__main__':
+    unittest.main()
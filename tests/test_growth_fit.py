@@ -0,0 +1,46 @@
+import unittest
+import warnings
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+from utils.growth_fit import BETA_ATOL, fit_windows, func
+
+
+def get_series(seed, ndays=120):
+    # cumulative counts growing at changing rates, with a flat stretch
+    rng = np.random.default_rng(seed)
+    rates = np.r_[np.full(40, 50), np.zeros(20), np.full(ndays - 60, 3)]
+    values = np.cumsum(rng.poisson(rates)) + 101.
+    values[70:75] = values[69]
+    return np.arange(ndays), values
+
+
+class FitWindowsTest(unittest.TestCase):
+
+    def test_beta_agrees_with_curve_fit(self):
+        time_range = 30
+        for seed in range(3):
+            days, values = get_series(seed)
+            end_days = days[::-1][:len(days) - time_range + 1]
+            fits = fit_windows(days, values, end_days, time_range)
+            for end_day, beta in zip(end_days, fits['beta']):
+                x = np.arange(1., time_range + 1)
+                y = values[end_day - time_range + 1:end_day + 1]
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    popt, _ = curve_fit(func, x, y, p0=[y[0], 0.03], maxfev=10000)
+                # a flat window is set to 0 whatever the small beta curve_fit finds
+                self.assertLess(abs(beta - popt[1]), 2 * BETA_ATOL if beta == 0 else BETA_ATOL)
+
+    def test_flat_window(self):
+        days = np.arange(30)
+        fits = fit_windows(days, np.full(30, 500.), days[-1:], 30)
+        self.assertEqual(fits['beta'][0], 0.)
+        self.assertEqual(fits['growth_rate'][0], 0.)
+        self.assertTrue(np.isnan(fits['doubling_time_fit'][0]))
+        self.assertFalse(fits['poor_fit'][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
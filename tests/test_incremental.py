@@ -0,0 +1,74 @@
+import functools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import calculate_daily_growth_rate
+from benchmarks.synthetic_data import get_synthetic_data
+from utils.export import read_json
+from utils.who_data import get_who_data
+
+NCOUNTRIES = 3
+NDAYS = 150
+
+
+class IncrementalTest(unittest.TestCase):
+    # calculate_daily_growth_rate.main on synthetic WHO data, run in a temporary
+    # directory: an incremental run has to give the same output as a full one
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.addCleanup(os.chdir, cwd)
+        self.df = get_synthetic_data(NCOUNTRIES, NDAYS)
+        self.iso3_list = sorted(self.df['ISO_3_CODE'].unique())
+        patches = [
+            mock.patch.object(calculate_daily_growth_rate, 'DIR_PATH', self.tmp_dir.name),
+            mock.patch.object(calculate_daily_growth_rate, 'WHO_COVID_FILENAME', 'who.csv'),
+            mock.patch.object(calculate_daily_growth_rate, 'get_country_list', lambda: list(self.iso3_list)),
+            mock.patch.object(calculate_daily_growth_rate, 'get_who_data',
+                              functools.partial(get_who_data, cache_dir=os.path.join(self.tmp_dir.name, 'cache'))),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_main(self, df, incremental=False, gzip_json=False):
+        df.to_csv('who.csv', index=False)
+        with mock.patch('builtins.print'):
+            calculate_daily_growth_rate.main(incremental=incremental, plots=False, gzip_json=gzip_json,
+                                             diagnostics=False)
+        return read_json(calculate_daily_growth_rate.get_json_filename('hrp_covid_doubling_rates', gzip_json))
+
+    def get_truncated(self, ndays):
+        # the data without its last ndays days
+        dates = sorted(self.df['date_epicrv'].unique())
+        return self.df[~self.df['date_epicrv'].isin(dates[-ndays:])]
+
+    def test_new_dates(self):
+        expected = self.run_main(self.df)
+        self.run_main(self.get_truncated(2))
+        self.assertEqual(self.run_main(self.df, incremental=True), expected)
+
+    def test_revised_row(self):
+        # an earlier row of a country changes: it is fitted again from scratch
+        df = self.df.copy()
+        row = df.index[(df['ISO_3_CODE'] == self.iso3_list[0])][NDAYS // 2]
+        df.loc[row, 'CumCase'] += 1000
+        expected = self.run_main(df)
+        self.run_main(self.get_truncated(2))
+        self.assertEqual(self.run_main(df, incremental=True), expected)
+
+    def test_plain_and_gzip_outputs(self):
+        # the state of the gzip run must not be used with an older plain output
+        expected = self.run_main(self.df)
+        self.run_main(self.get_truncated(2))
+        self.run_main(self.df, gzip_json=True)
+        self.assertEqual(self.run_main(self.df, incremental=True), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+# On-disk cache of parsed input files. A cached table is stored as a Feather file
+# together with a small metadata file recording the modification time, size and
+# sha256 of the source it was made from. The cache is used as long as the source is
+# unchanged: a matching mtime and size is enough, otherwise the hash is compared.
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), '.cache')
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_file_hash(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_cache_filenames(name, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f'{name}.feather'), os.path.join(cache_dir, f'{name}.meta.json')
+
+
+def get_source_meta(source_filename, key=None):
+    stat = os.stat(source_filename)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'key': key}
+
+
+def read_cache(name, source_filename, key=None, cache_dir=CACHE_DIR):
+    # Cached table for this source, or None if there is none or it is out of date.
+    # key holds anything else the table depends on (e.g. the parsing options).
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return None
+    table_filename, meta_filename = get_cache_filenames(name, cache_dir)
+    if not os.path.exists(table_filename) or not is_cache_valid(meta_filename, source_filename, key):
+        return None
+    return feather.read_table(table_filename, memory_map=True).to_pandas()
+
+
+def is_cache_valid(meta_filename, source_filename, key=None):
+    # Whether the metadata file was written for the current content of source_filename and key
+    if not os.path.exists(meta_filename):
+        return False
+    with open(meta_filename, 'r') as stream:
+        cached_meta = json.load(stream)
+    meta = get_source_meta(source_filename, key)
+    if cached_meta.get('key') != key:
+        return False
+    if (cached_meta['mtime'], cached_meta['size']) != (meta['mtime'], meta['size']):
+        # touched or copied: only invalid if the content changed
+        if cached_meta.get('sha256') != get_file_hash(source_filename):
+            return False
+        meta['sha256'] = cached_meta['sha256']
+        write_meta(meta_filename, meta)
+    return True
+
+
+def write_cache(name, source_filename, df, key=None, cache_dir=CACHE_DIR):
+    try:
+        import pyarrow.feather as feather
+    except ImportError:
+        return
+    table_filename, meta_filename = get_cache_filenames(name, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that a crash never leaves a broken cache behind
+    feather.write_feather(df.reset_index(drop=True), f'{table_filename}.tmp', compression='uncompressed')
+    os.replace(f'{table_filename}.tmp', table_filename)
+    write_source_meta(meta_filename, source_filename, key)
+
+
+def write_source_meta(meta_filename, source_filename, key=None):
+    meta = get_source_meta(source_filename, key)
+    meta['sha256'] = get_file_hash(source_filename)
+    write_meta(meta_filename, meta)
+
+
+def write_meta(meta_filename, meta):
+    with open(meta_filename, 'w') as stream:
+        json.dump(meta, stream, indent=2)
+
+
+def read_cached(name, source_filename, read_function, key=None, cache_dir=CACHE_DIR):
+    # Read source_filename with read_function, going through the cache (in cache_dir)
+    df = read_cache(name, source_filename, key, cache_dir)
+    if df is None:
+        df = read_function(source_filename)
+        write_cache(name, source_filename, df, key, cache_dir)
+    return df
+
@@ -0,0 +1,58 @@
+import functools
+import os
+
+import pandas as pd
+import yaml
+
+DIR_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+COUNTRIES_FILENAME = 'countries/admins.yaml'
+REGIONS_FILENAME = 'countries/tbl_regcov_2020_ocha.csv'
+# name of the group of all the countries in the list
+ALL_COUNTRIES_GROUP = 'H63'
+
+
+@functools.lru_cache(maxsize=None)
+def read_countries_file(filename=COUNTRIES_FILENAME):
+    with open(os.path.join(DIR_PATH, filename), 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+def get_country_list(filename=COUNTRIES_FILENAME):
+    country_list = read_countries_file(filename)['admin_info']
+    return sorted(list(set([country.get('alpha_3', None) for country in country_list])))
+
+
+def get_custom_groups(filename=COUNTRIES_FILENAME):
+    # Country lists defined under 'groups' in the countries file, e.g. H25
+    return {name: list(iso3_list) for name, iso3_list in read_countries_file(filename).get('groups', {}).items()}
+
+
+@functools.lru_cache(maxsize=None)
+def read_regions_file(filename=REGIONS_FILENAME):
+    return pd.read_csv(os.path.join(DIR_PATH, filename))
+
+
+def get_dict_regions(H63_iso3, filename=REGIONS_FILENAME):
+    dict_regions=read_regions_file(filename)
+    dict_regions=dict_regions[['ISO3','Regional_office']]
+    dict_regions=dict_regions[dict_regions['ISO3'].isin(H63_iso3)]
+    dict_regions=dict_regions.drop_duplicates(subset='ISO3')
+    return dict_regions
+
+
+def get_group_definitions(H63_iso3=None, custom_groups=True, regions=True):
+    """
+    Country groups to aggregate, as an ordered dict of group name -> list of iso3:
+    all the countries (H63), the custom groups of the countries file and, if
+    regions is set, one group per regional office.
+    """
+    if H63_iso3 is None:
+        H63_iso3 = get_country_list()
+    groups = {ALL_COUNTRIES_GROUP: list(H63_iso3)}
+    if custom_groups:
+        groups.update(get_custom_groups())
+    if regions:
+        dict_regions = get_dict_regions(H63_iso3)
+        for region, df_region in dict_regions.groupby('Regional_office'):
+            groups[region] = list(df_region['ISO3'])
+    return groups
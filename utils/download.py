@@ -0,0 +1,162 @@
+import csv
+import json
+import os
+import time
+
+import requests
+
+from utils.cache import get_file_hash
+from utils.export import create_temp_file
+
+CHUNK_SIZE = 1 << 20
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 60)
+RETRIES = 3
+BACKOFF_FACTOR = 2
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class DownloadError(Exception):
+    pass
+
+
+def get_meta_filename(save_path):
+    return f'{save_path}.download.json'
+
+
+def read_meta(save_path):
+    # ETag / Last-Modified of the previous download, if the file is still the one downloaded
+    meta_filename = get_meta_filename(save_path)
+    if not os.path.exists(save_path) or not os.path.exists(meta_filename):
+        return {}
+    with open(meta_filename, 'r') as stream:
+        meta = json.load(stream)
+    if meta.get('sha256') != get_file_hash(save_path):
+        return {}
+    return meta
+
+
+def write_meta(save_path, meta):
+    with open(get_meta_filename(save_path), 'w') as stream:
+        json.dump(meta, stream, indent=2)
+
+
+def count_csv_rows(filename):
+    with open(filename, 'r', newline='', encoding='utf-8') as stream:
+        return sum(1 for _ in csv.reader(stream)) - 1
+
+
+def validate_csv(filename, required_columns=None, min_rows=None, complete_columns=None):
+    # complete_columns must have a value on every row (e.g. columns read as integers)
+    with open(filename, 'r', newline='', encoding='utf-8') as stream:
+        reader = csv.reader(stream)
+        header = next(reader, [])
+        missing = set(required_columns or []) - set(header)
+        if missing:
+            raise DownloadError(f'Downloaded file is missing columns {sorted(missing)}')
+        complete = [(header.index(column), column) for column in complete_columns or [] if column in header]
+        nrows = 0
+        for row in reader:
+            nrows += 1
+            for icolumn, column in complete:
+                if icolumn >= len(row) or not row[icolumn].strip():
+                    raise DownloadError(f'Downloaded file has no {column} on row {nrows}')
+    if min_rows is not None and nrows < min_rows:
+        raise DownloadError(f'Downloaded file has {nrows} rows, expected at least {min_rows}')
+
+
+def get_range_validator(response):
+    # If-Range value identifying the version of the file of response: a strong
+    # ETag, or else Last-Modified (weak ETags cannot be used with ranges)
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def is_resumable(response):
+    # A partial download can be continued with a Range request if the server
+    # supports them, the body is not compressed on the fly and the version of the
+    # file can be checked, so that the rest does not come from another version
+    return response.headers.get('Accept-Ranges') == 'bytes' and 'Content-Encoding' not in response.headers \
+        and get_range_validator(response) is not None
+
+
+def fetch(url, headers, tmp_path, chunk_size, timeout, resume_from=0, validator=None):
+    # Stream url into tmp_path. Returns the response, or None if the file did not change.
+    # When resuming, the server sends the whole file again (200 instead of 206) if
+    # it is no longer the version of validator.
+    if resume_from:
+        headers = dict(headers, **{'Range': f'bytes={resume_from}-', 'If-Range': validator,
+                                   'Accept-Encoding': 'identity'})
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return None
+        if response.status_code in RETRY_STATUS_CODES:
+            raise DownloadError(f'HTTP {response.status_code} for "{url}"')
+        response.raise_for_status()
+        mode = 'ab' if resume_from and response.status_code == 206 else 'wb'
+        try:
+            with open(tmp_path, mode) as stream:
+                # iter_content decodes the gzip transfer encoding
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    stream.write(chunk)
+        except requests.RequestException as err:
+            # keep the headers around to decide whether the transfer can be resumed
+            err.response = response
+            raise
+        return response
+
+
+def download_url(url, save_path, chunk_size=CHUNK_SIZE, expected_sha256=None, validate=None,
+                 retries=RETRIES, backoff_factor=BACKOFF_FACTOR, timeout=TIMEOUT):
+    """
+    Download url to save_path. Returns False when the server reports that the file
+    did not change since the last download, True when save_path was replaced.
+    The file is written to a temporary file next to save_path, checked (sha256 and
+    the optional validate function) and only then moved over save_path, so save_path
+    is never left half written. Failed attempts are retried with exponential backoff,
+    continuing an interrupted transfer where the server allows it.
+    """
+    meta = read_meta(save_path)
+    headers = {'Accept-Encoding': 'gzip'}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    save_dir = os.path.dirname(os.path.abspath(save_path))
+    tmp_path = create_temp_file(save_dir, '.download_')
+    try:
+        resume_from, validator = 0, None
+        for attempt in range(retries + 1):
+            try:
+                response = fetch(url, headers, tmp_path, chunk_size, timeout, resume_from, validator)
+                break
+            except (DownloadError, requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as err:
+                if attempt == retries:
+                    raise DownloadError(f'Cannot download "{url}": {err}')
+                response = getattr(err, 'response', None)
+                wait = backoff_factor ** attempt
+                print(f'Download of "{url}" failed ({err}), retrying in {wait} s')
+                time.sleep(wait)
+                if response is not None and is_resumable(response):
+                    resume_from, validator = os.path.getsize(tmp_path), get_range_validator(response)
+                else:
+                    resume_from, validator = 0, None
+        if response is None:
+            print(f'"{url}" has not changed since the last download')
+            return False
+        sha256 = get_file_hash(tmp_path)
+        if expected_sha256 is not None and sha256 != expected_sha256:
+            raise DownloadError(f'Checksum mismatch for "{url}": got {sha256}, expected {expected_sha256}')
+        if validate is not None:
+            validate(tmp_path)
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    write_meta(save_path, {'url': url, 'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified'), 'sha256': sha256})
+    print(f'Downloaded "{url}" to "{save_path}"')
+    return True
@@ -0,0 +1,255 @@
+import contextlib
+import gzip
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Output writers that stream the tables group by group / row by row instead of
+# building a dict for every row. The JSON is {"<group>": [<record>, ...], ...}
+# with the records encoded by pandas, byte for byte what
+# df.groupby(column).apply(lambda x: x.to_dict('records')).to_json(orient='index', indent=2)
+# gives, or the same without whitespace in compact mode.
+JSON_INDENT = 2
+# rows converted for the XLSX writer at a time
+XLSX_CHUNK_SIZE = 10000
+XLSX_SHEET_NAME = 'Sheet1'
+
+
+def add_json_arguments(parser):
+    parser.add_argument('--compact-json', action='store_true', help='Write the JSON output without indentation')
+    parser.add_argument('--gzip-json', action='store_true', help='Write the JSON output gzip compressed (.json.gz)')
+
+
+def create_temp_file(directory, prefix):
+    # New empty file in directory, returns its path. It is created like open()
+    # does, with the permissions the umask gives (mkstemp files are private).
+    while True:
+        tmp_path = os.path.join(directory, f'{prefix}{os.urandom(6).hex()}')
+        try:
+            os.close(os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            return tmp_path
+        except FileExistsError:
+            continue
+
+
+def get_json_filename(basename, compress=False):
+    return f'{basename}.json.gz' if compress else f'{basename}.json'
+
+
+@contextlib.contextmanager
+def atomic_output(filename, mode='w'):
+    # Write to a temporary file next to filename and move it over filename once
+    # complete, so readers never see a half written output. Gzip compressed if
+    # filename ends with .gz.
+    tmp_path = create_temp_file(os.path.dirname(os.path.abspath(filename)), '.export_')
+    opener = gzip.open if filename.endswith('.gz') else open
+    try:
+        if 'b' in mode:
+            stream = opener(tmp_path, mode)
+        else:
+            stream = opener(tmp_path, mode + 't', encoding='utf-8')
+        with stream:
+            yield stream
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_json(filename):
+    # JSON output, plain or gzip compressed
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8') as stream:
+        return json.load(stream)
+
+
+class JsonRecordsWriter:
+    """
+    Writes {"<key>": [<records>], ...} one group at a time. Each group's records
+    are encoded by DataFrame.to_json, so numbers come out exactly as pandas writes
+    them (10 decimals, NaN as null). The records of a group can be written in
+    several pieces, as long as no other group is written in between.
+    """
+
+    def __init__(self, stream, compact=False):
+        self.stream = stream
+        self.compact = compact
+        self.ngroups = 0
+        # group whose records are being written, and whether it has any yet
+        self.key = None
+        self.nrecords = 0
+        self.keys = set()
+
+    def __enter__(self):
+        self.stream.write('{')
+        return self
+
+    def write(self, key, df):
+        key = str(key)
+        if key != self.key:
+            self.close_group()
+            if key in self.keys:
+                raise ValueError(f'The records of "{key}" are not one after the other')
+            separator = ('\n' + ' ' * JSON_INDENT if not self.compact else '')
+            self.stream.write(f'{"," if self.ngroups else ""}{separator}{json.dumps(key)}:[')
+            self.key = key
+            self.keys.add(key)
+            self.nrecords = 0
+            self.ngroups += 1
+        if len(df) == 0:
+            return
+        if self.compact:
+            records = df.to_json(orient='records')[1:-1]
+        else:
+            # records nested one level down, without the brackets and the line before the closing one
+            records = df.to_json(orient='records', indent=JSON_INDENT).replace('\n', '\n' + ' ' * JSON_INDENT)
+            records = records[1:-len('\n' + ' ' * JSON_INDENT + ']')]
+        self.stream.write(f'{"," if self.nrecords else ""}{records}')
+        self.nrecords += len(df)
+
+    def close_group(self):
+        if self.key is None:
+            return
+        if self.compact or not self.nrecords:
+            self.stream.write(']')
+        else:
+            self.stream.write('\n' + ' ' * JSON_INDENT + ']')
+        self.key = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_group()
+        self.stream.write('\n}' if self.ngroups and not self.compact else '}')
+
+
+def get_xlsx_values(df):
+    # cell values of a block of rows: missing values as empty cells, infinities as text like to_excel
+    values = df.astype(object).to_numpy()
+    for icolumn, dtype in enumerate(df.dtypes):
+        if dtype.kind != 'f':
+            continue
+        column = df.iloc[:, icolumn].to_numpy()
+        values[np.isnan(column), icolumn] = None
+        values[np.isposinf(column), icolumn] = 'inf'
+        values[np.isneginf(column), icolumn] = '-inf'
+    return values
+
+
+class XlsxWriter:
+    """
+    Same sheet as df.to_excel(filename), with the index in the first column, but
+    written with a write-only openpyxl workbook that streams the rows to a
+    temporary file instead of keeping a cell object for each of them. The rows
+    can be appended in several pieces.
+    """
+
+    def __init__(self, columns, chunk_size=XLSX_CHUNK_SIZE):
+        from openpyxl import Workbook
+        from openpyxl.styles import Alignment, Border, Font, Side
+        self.chunk_size = chunk_size
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(XLSX_SHEET_NAME)
+        # the header and index style of to_excel
+        side = Side(style='thin')
+        self.style = {'font': Font(bold=True), 'border': Border(left=side, right=side, top=side, bottom=side),
+                      'alignment': Alignment(horizontal='center', vertical='top')}
+        self.sheet.append([None] + [self.header_cell(str(column)) for column in columns])
+
+    def header_cell(self, value):
+        from openpyxl.cell import WriteOnlyCell
+        cell = WriteOnlyCell(self.sheet, value=value)
+        cell.font, cell.border, cell.alignment = self.style['font'], self.style['border'], self.style['alignment']
+        return cell
+
+    def append(self, df, index=None):
+        # rows of df, with index in the first column instead of the index of df if given
+        index = df.index if index is None else index
+        for start in range(0, len(df), self.chunk_size):
+            block = df.iloc[start:start + self.chunk_size]
+            for value, row in zip(index[start:start + self.chunk_size], get_xlsx_values(block)):
+                self.sheet.append([self.header_cell(value)] + list(row))
+
+    def save(self, filename):
+        with atomic_output(filename, 'wb') as stream:
+            self.workbook.save(stream)
+
+
+def write_xlsx(df, filename, chunk_size=XLSX_CHUNK_SIZE):
+    writer = XlsxWriter(df.columns, chunk_size)
+    writer.append(df)
+    writer.save(filename)
+
+
+def write_json_records(df, filename, group_column, compact=False):
+    # groups in sorted order, rows in the order of df, like groupby().apply()
+    with atomic_output(filename) as stream, JsonRecordsWriter(stream, compact) as writer:
+        for key, group in df.groupby(group_column, sort=True):
+            writer.write(key, group)
+
+
+def export_table(df, basename, group_column, compact=False, compress=False, xlsx=True):
+    """
+    Save df as <basename>.json (records by group_column, see write_json_records),
+    optionally compact and/or gzip compressed as <basename>.json.gz, and as
+    <basename>.xlsx. The two files are written concurrently. Returns the filenames.
+    """
+    filenames = [get_json_filename(basename, compress)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(write_json_records, df, filenames[0], group_column, compact)]
+        if xlsx:
+            filenames.append(f'{basename}.xlsx')
+            futures.append(executor.submit(write_xlsx, df, filenames[1]))
+        for future in futures:
+            future.result()
+    return filenames
+
+
+class TableStreamWriter:
+    """
+    export_table for a table that comes in pieces: every piece given to append is
+    written to <basename>.json(.gz) and <basename>.xlsx right away, so the table
+    is never held in memory. The rows of a group have to come one after the
+    other; groups are written in the order they come, not sorted. The XLSX index
+    is the row number in the whole table.
+    """
+
+    def __init__(self, basename, group_column, compact=False, compress=False, xlsx=True):
+        self.group_column = group_column
+        self.filenames = [get_json_filename(basename, compress)]
+        if xlsx:
+            self.filenames.append(f'{basename}.xlsx')
+        self.compact = compact
+        self.xlsx = xlsx
+        self.exit_stack = contextlib.ExitStack()
+        self.xlsx_writer = None
+        self.columns = None
+        self.nrows = 0
+
+    def __enter__(self):
+        stream = self.exit_stack.enter_context(atomic_output(self.filenames[0]))
+        self.json_writer = self.exit_stack.enter_context(JsonRecordsWriter(stream, self.compact))
+        return self
+
+    def append(self, df):
+        # the columns of the first piece, empty where a piece does not have them
+        if self.columns is None:
+            self.columns = list(df.columns)
+        df = df.reindex(columns=self.columns)
+        if self.xlsx:
+            if self.xlsx_writer is None:
+                self.xlsx_writer = XlsxWriter(self.columns)
+            self.xlsx_writer.append(df, np.arange(self.nrows, self.nrows + len(df)))
+        self.nrows += len(df)
+        # consecutive rows of the same group in one piece
+        keys = df[self.group_column].to_numpy()
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(df) else []
+        for start, stop in zip(starts, list(starts[1:]) + [len(df)]):
+            self.json_writer.write(keys[start], df.iloc[start:stop])
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.exit_stack.__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and self.xlsx:
+            if self.xlsx_writer is None:
+                self.xlsx_writer = XlsxWriter([])
+            self.xlsx_writer.save(self.filenames[1])
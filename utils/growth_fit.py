@@ -0,0 +1,270 @@
+import numpy as np
+import pandas as pd
+
+from utils.profiling import count
+
+# Batched least-squares fit of p0*exp(beta*x) over sliding windows.
+# Every window of a country is solved at the same time: a log-linear regression
+# gives the starting point and a vectorized Levenberg-Marquardt refines it on the
+# same objective as scipy's curve_fit. The fitted beta agrees with curve_fit to
+# within BETA_ATOL and the residual sum of squares is never larger than curve_fit's
+# (the differences come from curve_fit's own stopping tolerance). A window whose
+# |beta| is below BETA_ATOL is flat: the sign of such a beta is noise, so it is set
+# to 0 and the window gets a growth rate of 0 and no doubling time (NaN, not a
+# huge or infinite one). It is kept, not dropped like a decreasing window.
+# Windows that do not converge are started again from the solution of the nearest
+# window that did, then handed to curve_fit with a bounded number of evaluations
+# and, if that fails too, left at the log-linear estimate. The method used is
+# recorded for every window along with a few quality measures.
+# Each country is first turned into a dense daily series, days without a report
+# taking the previous cumulative value, so that a window always spans time_range
+# days and all the windows are views into that one array.
+BETA_ATOL = 1e-6
+# version of the fit, to bump whenever a change gives different results: outputs
+# of another version are not reused by the incremental mode
+FIT_VERSION = 2
+# relative step size below which a window is considered converged
+STEP_TOL = 1e-10
+MAX_ITERATIONS = 100
+# damping beyond which the step is useless and the window is given up
+MAX_DAMPING = 1e12
+# function evaluations allowed to curve_fit
+CURVE_FIT_MAXFEV = 400
+# the doubling times from the fit and from the first and last values of the window
+# should agree within this fraction, otherwise the fit is flagged as poor
+MAX_DOUBLING_TIME_DIFF = 0.2
+FIT_METHODS = ['levenberg_marquardt', 'warm_start', 'curve_fit', 'log_linear']
+FIT_COLUMNS = ['p0', 'beta', 'growth_rate', 'doubling_time_fit', 'doubling_time_val',
+               'npoints', 'nimputed', 'first_row', 'last_row', 'converged', 'method', 'relative_rmse',
+               'doubling_time_diff', 'poor_fit']
+# the columns describing how well each window was fitted
+DIAGNOSTIC_COLUMNS = ['method', 'converged', 'npoints', 'nimputed', 'beta', 'doubling_time_fit',
+                      'doubling_time_val', 'doubling_time_diff', 'relative_rmse', 'poor_fit']
+
+
+def func(x, p0, beta):
+    return p0 * np.exp(x*beta)
+
+
+def get_window_bounds(days, end_days, time_range):
+    # rows [first_row, last_row) of each window: end_day - time_range < day <= end_day
+    first_row = np.searchsorted(days, end_days - time_range, side='right')
+    last_row = np.searchsorted(days, end_days, side='right')
+    return first_row, last_row
+
+
+def get_dense_series(days, values):
+    """
+    Daily series from the first to the last day of days. Days without a value take
+    the one of the previous day (cumulative counts do not change without a report).
+    Returns the first day, the values and a mask of the imputed days.
+    """
+    if len(days) == 0:
+        return 0, np.zeros(0), np.zeros(0, dtype=bool)
+    dense_days = np.arange(days[0], days[-1] + 1)
+    row = np.searchsorted(days, dense_days, side='right') - 1
+    return days[0], np.asarray(values, dtype=float)[row], days[row] != dense_days
+
+
+def get_windows(array, start, time_range):
+    # (nwindows, time_range) windows of array starting at start. They are a view of
+    # array when the windows follow each other (the usual case), a copy otherwise.
+    windows = np.lib.stride_tricks.as_strided(array, shape=(max(len(array) - time_range + 1, 0), time_range),
+                                              strides=array.strides * 2, writeable=False)
+    if len(start) > 1 and np.all(np.diff(start) == start[1] - start[0]) and abs(start[1] - start[0]) == 1:
+        step = start[1] - start[0]
+        stop = start[-1] + step
+        return windows[start[0]:stop if stop >= 0 else None:step]
+    return windows[start]
+
+
+def get_window_matrix(dense_series, end_days, time_range):
+    # (nwindows, time_range) arrays of the windows ending on end_days: x (days from
+    # the start of the window), y, mask of the days inside the series and imputed.
+    # The series is padded in front so that every window, even one starting before
+    # the first day, is a slice of it.
+    first_day, values, imputed = dense_series
+    padding = time_range - 1
+    inside = np.concatenate([np.zeros(padding, dtype=bool), np.ones(len(values), dtype=bool)])
+    values = np.concatenate([np.zeros(padding), values])
+    imputed = np.concatenate([np.zeros(padding, dtype=bool), imputed])
+    # window of end_day starts at end_day - time_range + 1, i.e. at end_day - first_day when padded
+    start = np.asarray(end_days - first_day, dtype=np.int64)
+    x = np.broadcast_to(np.arange(1., time_range + 1), (len(start), time_range))
+    return (x, get_windows(values, start, time_range), get_windows(inside, start, time_range),
+            get_windows(imputed, start, time_range))
+
+
+def fit_log_linear(x, y, mask):
+    # Weighted regression of log(y) on x, one line per window
+    mask = mask & (y > 0)
+    logy = np.log(np.where(mask, y, 1.))
+    n = mask.sum(axis=1)
+    sx = (x * mask).sum(axis=1)
+    sy = (logy * mask).sum(axis=1)
+    sxx = (x * x * mask).sum(axis=1)
+    sxy = (x * logy * mask).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+        log_p0 = (sy - beta * sx) / n
+    return np.exp(log_p0), beta
+
+
+def fit_levenberg_marquardt(x, y, mask, p0, beta, max_iter=MAX_ITERATIONS):
+    # Minimise sum((y - p0*exp(beta*x))**2) for all windows at once.
+    # Each iteration solves the 2x2 damped normal equations in closed form.
+    def get_cost(p0, beta):
+        residual = (y - p0[:, None] * np.exp(beta[:, None] * x)) * mask
+        return (residual ** 2).sum(axis=1)
+
+    p0 = p0.copy()
+    beta = beta.copy()
+    damping = np.full(len(p0), 1e-3)
+    active = np.isfinite(p0) & np.isfinite(beta) & (mask.sum(axis=1) >= 2)
+    converged = np.zeros(len(p0), dtype=bool)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        cost = get_cost(p0, beta)
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            exp_bx = np.exp(beta[:, None] * x) * mask
+            fitted = p0[:, None] * exp_bx
+            residual = (y - fitted) * mask
+            j_p0 = exp_bx
+            j_beta = fitted * x
+            a11 = (j_p0 ** 2).sum(axis=1)
+            a12 = (j_p0 * j_beta).sum(axis=1)
+            a22 = (j_beta ** 2).sum(axis=1)
+            g1 = (j_p0 * residual).sum(axis=1)
+            g2 = (j_beta * residual).sum(axis=1)
+            d11 = a11 * (1 + damping)
+            d22 = a22 * (1 + damping)
+            det = d11 * d22 - a12 ** 2
+            step_p0 = (d22 * g1 - a12 * g2) / det
+            step_beta = (d11 * g2 - a12 * g1) / det
+            new_p0 = p0 + step_p0
+            new_beta = beta + step_beta
+            new_cost = get_cost(new_p0, new_beta)
+            small_step = (np.abs(step_p0) <= STEP_TOL * (np.abs(p0) + STEP_TOL)) & \
+                         (np.abs(step_beta) <= STEP_TOL * (np.abs(beta) + STEP_TOL))
+            accept = active & np.isfinite(new_cost) & ((new_cost <= cost) | small_step)
+            p0 = np.where(accept, new_p0, p0)
+            beta = np.where(accept, new_beta, beta)
+            cost = np.where(accept, new_cost, cost)
+            damping = np.where(accept, damping / 10, damping * 10)
+            converged |= active & small_step
+            active &= ~small_step & (damping < MAX_DAMPING)
+    return p0, beta, converged
+
+
+def fit_windows(days, values, end_days, time_range, dense_series=None):
+    """
+    Fit the exponential model to every window of a single country.
+    days and values are the sorted day numbers and cumulative counts of the country,
+    end_days the last day of each window. dense_series is get_dense_series(days, values)
+    if already computed. Returns one row per window.
+    """
+    if dense_series is None:
+        dense_series = get_dense_series(days, values)
+    x, y, mask, imputed = get_window_matrix(dense_series, end_days, time_range)
+    first_row, last_row = get_window_bounds(days, end_days, time_range)
+    npoints = mask.sum(axis=1)
+    nimputed = imputed.sum(axis=1)
+    count('fit_windows', len(end_days))
+    count('imputed_windows', int((nimputed > 0).sum()))
+    # Scale each window by its first value so that p0 is of order one
+    initial_val = np.where(npoints > 0, y[np.arange(len(y)), np.minimum(time_range - npoints, time_range - 1)],
+                           np.nan)
+    scale = np.where(initial_val > 0, initial_val, 1.)
+    y_scaled = y / scale[:, None]
+    p0_log_linear, beta_log_linear = fit_log_linear(x, y_scaled, mask)
+    p0, beta, converged = fit_levenberg_marquardt(x, y_scaled, mask, p0_log_linear, beta_log_linear)
+    method = np.where(npoints >= 2, FIT_METHODS[0], None).astype(object)
+    p0 = p0 * scale
+    # Start the windows that did not converge from their nearest converged neighbour
+    failed = np.flatnonzero(~converged & (npoints >= 2))
+    neighbour = get_nearest_converged(converged, failed)
+    p0_start, beta_start = shift_solution(p0[neighbour], beta[neighbour], end_days[neighbour], end_days[failed])
+    warm = neighbour >= 0
+    p0_start[~warm] = np.nan
+    count('fit_warm_starts', int(warm.sum()))
+    if warm.any():
+        iwarm = failed[warm]
+        p0_warm, beta[iwarm], converged[iwarm] = fit_levenberg_marquardt(
+            x[iwarm], y_scaled[iwarm], mask[iwarm], p0_start[warm] / scale[iwarm], beta_start[warm])
+        p0[iwarm] = p0_warm * scale[iwarm]
+        method[iwarm[converged[iwarm]]] = 'warm_start'
+    # Fall back on the full nonlinear solver for anything left over (from the same
+    # starting point), and on the log-linear estimate if that fails too
+    fallback = ~converged[failed]
+    count('curve_fit_calls', int(fallback.sum()))
+    for iwindow, p0_guess, beta_guess in zip(failed[fallback], p0_start[fallback], beta_start[fallback]):
+        window_mask = mask[iwindow]
+        initial_guess = [p0_guess, beta_guess] if np.isfinite(p0_guess) else None
+        try:
+            p0[iwindow], beta[iwindow] = fit_curve_fit(x[iwindow][window_mask], y[iwindow][window_mask],
+                                                       initial_guess)
+            converged[iwindow] = True
+            method[iwindow] = 'curve_fit'
+        except (RuntimeError, ValueError):
+            count('log_linear_fallbacks')
+            p0[iwindow] = p0_log_linear[iwindow] * scale[iwindow]
+            beta[iwindow] = beta_log_linear[iwindow]
+            method[iwindow] = 'log_linear'
+    # flat windows, see above
+    flat = np.abs(beta) < BETA_ATOL
+    beta[flat] = 0.
+    count('flat_windows', int(flat.sum()))
+    # alternative doubling time from the first and last observation of the window
+    final_val = y[:, -1]
+    ndays = x[:, -1]
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        growth_rate = np.exp(beta) - 1
+        doubling_time_fit = np.where(flat, np.nan, np.log(2) / beta)
+        doubling_time_val = ndays * np.log(2) / np.log(final_val / initial_val)
+        # quality of the fit
+        residual = (y - func(x, p0[:, None], beta[:, None])) * mask
+        relative_rmse = np.sqrt((residual ** 2).sum(axis=1) / npoints) / ((y * mask).sum(axis=1) / npoints)
+        doubling_time_diff = np.abs(doubling_time_fit - doubling_time_val) / np.abs(doubling_time_val)
+    # windows without a meaningful doubling time (e.g. flat) are not flagged
+    poor_fit = doubling_time_diff > MAX_DOUBLING_TIME_DIFF
+    count('poor_fits', int(poor_fit.sum()))
+    return pd.DataFrame({'p0': p0, 'beta': beta, 'growth_rate': growth_rate,
+                         'doubling_time_fit': doubling_time_fit, 'doubling_time_val': doubling_time_val,
+                         'npoints': npoints, 'nimputed': nimputed, 'first_row': first_row, 'last_row': last_row,
+                         'converged': converged, 'method': method, 'relative_rmse': relative_rmse,
+                         'doubling_time_diff': doubling_time_diff, 'poor_fit': poor_fit}, columns=FIT_COLUMNS)
+
+
+def get_nearest_converged(converged, windows):
+    # index of the converged window closest to each of windows, -1 if there is none
+    converged_index = np.flatnonzero(converged)
+    if len(converged_index) == 0:
+        return np.full(len(windows), -1)
+    position = np.searchsorted(converged_index, windows)
+    before = converged_index[np.maximum(position - 1, 0)]
+    after = converged_index[np.minimum(position, len(converged_index) - 1)]
+    return np.where(np.abs(windows - before) <= np.abs(after - windows), before, after)
+
+
+def shift_solution(p0, beta, end_days, new_end_days):
+    # the same curve, with x counted from the start of windows ending on new_end_days
+    with np.errstate(over='ignore'):
+        return p0 * np.exp(beta * (new_end_days - end_days)), beta
+
+
+def fit_curve_fit(x, y, initial_guess=None):
+    from scipy.optimize import curve_fit
+    if initial_guess is None:
+        initial_guess = [y[0], 0.03]
+    try:
+        popt, pcov = curve_fit(func, x, y, p0=initial_guess, maxfev=CURVE_FIT_MAXFEV)
+    except (RuntimeError, ValueError):
+        count('curve_fit_failures')
+        raise
+    return popt
+
+
+def get_day_numbers(dates):
+    # integer day number of each date, for window arithmetic
+    return pd.to_datetime(pd.Series(dates)).values.astype('datetime64[D]').astype(np.int64)
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils.cache import get_file_hash
+from utils.export import read_json
+
+# Bookkeeping for incremental runs: for every country we keep a fingerprint of
+# the rows that went into the previous output. If those rows are unchanged only
+# the windows ending on new dates have to be fitted, otherwise the country is
+# recomputed from scratch. The state also records the sha256 of the output it
+# was written with: the plain and the gzip compressed outputs share the state
+# file, and a state is only used with the very file it describes.
+
+
+def get_fingerprint(days, values):
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(days, dtype=np.int64).tobytes())
+    sha.update(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+    return sha.hexdigest()
+
+
+def get_state_filename(output_filename):
+    # the same state file for the plain and the gzip compressed output
+    if output_filename.endswith('.gz'):
+        output_filename = output_filename[:-len('.gz')]
+    return f'{os.path.splitext(output_filename)[0]}.state.json'
+
+
+def read_state(output_filename, config):
+    # Previous state, or an empty one if it is missing, was made with another config
+    # or for another output file (e.g. the other of the plain and gzip outputs)
+    state_filename = get_state_filename(output_filename)
+    if not os.path.exists(output_filename) or not os.path.exists(state_filename):
+        return {}
+    with open(state_filename, 'r') as stream:
+        state = json.load(stream)
+    if state.get('config') != config or state.get('output_sha256') != get_file_hash(output_filename):
+        return {}
+    return state.get('countries', {})
+
+
+def write_state(output_filename, config, countries):
+    with open(get_state_filename(output_filename), 'w') as stream:
+        json.dump({'config': config, 'output_sha256': get_file_hash(output_filename), 'countries': countries},
+                  stream, indent=2, sort_keys=True)
+
+
+def get_country_state(days, values):
+    return {'nrows': len(days), 'fingerprint': get_fingerprint(days, values)}
+
+
+def get_nwindows_to_update(previous, days, values, nwindows):
+    # Number of windows (counted from the latest date) that need to be fitted,
+    # or None when the whole country has to be recomputed
+    if previous is None:
+        return None
+    nrows = previous['nrows']
+    if len(days) < nrows or get_fingerprint(days[:nrows], values[:nrows]) != previous['fingerprint']:
+        # an earlier row was revised or removed
+        return None
+    return min(len(days) - nrows, nwindows)
+
+
+def read_previous_output(output_filename):
+    # Records of the previous JSON output, as one DataFrame per country
+    records = read_json(output_filename)
+    previous_output = {}
+    for iso3, rows in records.items():
+        df = pd.DataFrame(rows)
+        df['date'] = pd.to_datetime(df['date']).dt.date
+        previous_output[iso3] = df
+    return previous_output
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+from utils.cache import CACHE_DIR, is_cache_valid, write_source_meta
+from utils.plotting import PLOTS_DIR, get_pyplot, render_panels
+
+# Choropleth maps of the countries. The 1:10m Natural Earth shapes are read once,
+# reduced to the countries that are mapped and simplified, and this layer is kept
+# in the on-disk cache as GeoParquet until the shapefile (its .shp, .dbf and .shx
+# files), the countries or the tolerance change. Values are joined to the layer
+# with one row per country (the latest one, or the one of a date), never with the
+# whole time series.
+# geopandas is only imported when a map is made.
+DIR_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FILENAME_SHP = 'ne_10m_admin_0_countries/ne_10m_admin_0_countries.shp'
+SHAPE_KEY = 'ADM0_A3'
+MAP_LAYER_NAME = 'map_layer'
+# files of a shapefile the layer is read from: geometry, attributes and index
+SHAPEFILE_EXTENSIONS = ['.shp', '.dbf', '.shx']
+# in degrees, about 2 km: far below what shows on a map of a continent
+SIMPLIFY_TOLERANCE = 0.02
+MISSING_COLOR = 'lightgrey'
+
+
+def get_layer_filenames(filename, name=MAP_LAYER_NAME):
+    # the cached layer, and the parts of the shapefile filename with their metadata file
+    basename = os.path.splitext(filename)[0]
+    return os.path.join(CACHE_DIR, f'{name}.parquet'), \
+        [(f'{basename}{extension}', os.path.join(CACHE_DIR, f'{name}{extension}.meta.json'))
+         for extension in SHAPEFILE_EXTENSIONS]
+
+
+def read_shapes(filename, iso3_list, tolerance=SIMPLIFY_TOLERANCE):
+    import geopandas as gpd
+    gdf = gpd.read_file(filename)
+    gdf = gdf.loc[gdf[SHAPE_KEY].isin(iso3_list), [SHAPE_KEY, 'geometry']]
+    gdf['geometry'] = gdf.geometry.simplify(tolerance, preserve_topology=True)
+    return gdf.sort_values(SHAPE_KEY).reset_index(drop=True)
+
+
+def get_map_layer(iso3_list, filename=FILENAME_SHP, tolerance=SIMPLIFY_TOLERANCE):
+    # simplified shapes of the countries of iso3_list (ADM0_A3 codes), through the cache
+    import geopandas as gpd
+    filename = os.path.join(DIR_PATH, filename)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return read_shapes(filename, iso3_list, tolerance)
+    layer_filename, sources = get_layer_filenames(filename)
+    key = {'iso3': sorted(iso3_list), 'tolerance': tolerance}
+    if os.path.exists(layer_filename) and all(is_cache_valid(source_meta_filename, source_filename, key)
+                                              for source_filename, source_meta_filename in sources):
+        return gpd.read_parquet(layer_filename)
+    gdf = read_shapes(filename, iso3_list, tolerance)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    gdf.to_parquet(f'{layer_filename}.tmp', index=False)
+    os.replace(f'{layer_filename}.tmp', layer_filename)
+    for source_filename, source_meta_filename in sources:
+        write_source_meta(source_meta_filename, source_filename, key)
+    return gdf
+
+
+def get_latest_values(df, columns, key='iso3', date_column='date'):
+    # the row of the most recent date of every country, indexed by country
+    df = df.sort_values(date_column, kind='mergesort')
+    return df.drop_duplicates(key, keep='last').set_index(key)[columns]
+
+
+def join_values(layer, values):
+    # values indexed by country on the shapes, the countries without one are kept
+    return layer.merge(values, left_on=SHAPE_KEY, right_index=True, how='left')
+
+
+def plot_map(name, data, filename):
+    # data: the layer with the values joined and the options of the map
+    gdf, column, options = data
+    plt = get_pyplot()
+    fig, axis = plt.subplots(figsize=[15, 10])
+    kwargs = {'cmap': options.get('cmap', 'OrRd'), 'vmin': options.get('vmin'), 'vmax': options.get('vmax')}
+    if options.get('scheme'):
+        kwargs['scheme'] = options['scheme']
+    elif options.get('label'):
+        kwargs['legend_kwds'] = {'label': options['label'], 'orientation': 'horizontal'}
+    # the shapes are filled and outlined in the same pass
+    gdf.plot(column=column, ax=axis, legend=gdf[column].notna().any(), edgecolor='black', linewidth=0.5,
+             missing_kwds={'color': MISSING_COLOR}, **kwargs)
+    axis.set_title(options.get('title', column))
+    axis.set_axis_off()
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def render_map(layer, df, column, output_dir=PLOTS_DIR, name='map', plot_format='png', key='iso3',
+               date_column='date', **options):
+    # map of the latest value of column of every country
+    gdf = join_values(layer, get_latest_values(df, [column], key, date_column))
+    return render_panels(plot_map, [('latest', (gdf, column, options))], output_dir=output_dir, name=name,
+                         plot_format=plot_format)[0]
+
+
+def render_map_frames(layer, df, column, output_dir=PLOTS_DIR, name='map', plot_format='png', workers=1,
+                      key='iso3', date_column='date', **options):
+    """
+    One map of column per date of df (e.g. the frames of an animation), drawn in
+    parallel with workers processes. All the frames share the colour scale of the
+    values of the mapped countries. Returns the filenames, in date order.
+    """
+    df = df[df[key].isin(layer[SHAPE_KEY])]
+    values = df[column].to_numpy(dtype=float)
+    values = values[np.isfinite(values)]
+    if len(values):
+        options.setdefault('vmin', values.min())
+        options.setdefault('vmax', values.max())
+    panels = []
+    for date, df_date in df.groupby(date_column, sort=True):
+        frame_options = dict(options, title=f'{options.get("title", column)} {date}')
+        gdf = join_values(layer, df_date.drop_duplicates(key).set_index(key)[[column]])
+        panels.append((str(date), (gdf, column, frame_options)))
+    return render_panels(plot_map, panels, output_dir=output_dir, name=name, plot_format=plot_format,
+                         workers=workers)
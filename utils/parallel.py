@@ -0,0 +1,25 @@
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import profiling
+
+# The pools do not fork the calling process: it can have other threads (e.g.
+# the stages run by the pipeline) holding locks that would stay locked forever in
+# the child. Workers are forked from a clean server process where possible.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def map_countries(function, *iterables, workers=1):
+    # Apply function to the items of iterables (like the builtin map), in a
+    # process pool when workers > 1. Results always come back in the order of
+    # the items so that the output is the same as in a serial run. What the
+    # workers record in their profiler is added to the one of this process.
+    items = list(zip(*iterables))
+    if workers is None or workers <= 1 or len(items) <= 1:
+        return [function(*item) for item in items]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD)) as executor:
+        results = list(executor.map(functools.partial(profiling.run_profiled, function), *zip(*items)))
+    for _, profile in results:
+        profiling.PROFILER.merge(profile)
+    return [result for result, _ in results]
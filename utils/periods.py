@@ -0,0 +1,112 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from utils.growth_fit import get_day_numbers
+
+# Comparison of the cumulative counts at the start and end of reporting periods,
+# for every country and group and every period in one pass: the table is sorted
+# by (code, date) once and the period boundaries are found by binary search.
+# A period is a dict with a name, start and end dates and the labels of the start
+# and end in the output columns (e.g. june_cases, CFR_july).
+VALUE_COLUMNS = {'CumCase': 'cases', 'CumDeath': 'deaths'}
+PERIOD_LABELS = ['start', 'end']
+
+
+def parse_date(date):
+    if isinstance(date, datetime.date):
+        return date
+    return datetime.datetime.strptime(str(date), '%Y-%m-%d').date()
+
+
+def get_period(start, end, name=None, labels=None):
+    start, end = parse_date(start), parse_date(end)
+    if end < start:
+        raise ValueError(f'Period {start} - {end} ends before it starts')
+    return {'name': name or f'{start}_{end}', 'start': start, 'end': end, 'labels': list(labels or PERIOD_LABELS)}
+
+
+def read_periods_file(filename):
+    # periods from the 'periods' list of a YAML file, with the keys of get_period
+    with open(filename, 'r') as stream:
+        return [get_period(**period) for period in yaml.safe_load(stream)['periods']]
+
+
+def add_period_arguments(parser):
+    parser.add_argument('-p', '--period', nargs='+', action='append', metavar='ARG',
+                        help='Period to compare as START END [NAME [START_LABEL END_LABEL]], dates as YYYY-MM-DD; '
+                             'can be repeated')
+    parser.add_argument('-c', '--config', help='YAML file with a list of periods under "periods"')
+
+
+def get_periods_from_args(parser, args, default_periods):
+    # periods of the config file and of the --period arguments, default_periods if none
+    periods = read_periods_file(args.config) if args.config else []
+    for period in args.period or []:
+        if len(period) not in [2, 3, 5]:
+            parser.error('--period takes START END [NAME [START_LABEL END_LABEL]]')
+        try:
+            periods.append(get_period(*period[:3], labels=period[3:] or None))
+        except ValueError as err:
+            parser.error(str(err))
+    return periods or default_periods
+
+
+def get_period_bounds(df, periods, code_column='ISO_3_CODE', date_column='date_epicrv'):
+    """
+    Rows of df at the start and end of each period for every code: the first report
+    on or after the start date and the last one on or before the end date. Returns
+    the period index, code, start row and end row of the (period, code) pairs with
+    at least one report in the period, by period and then code (sorted).
+    """
+    codes, code_names = pd.factorize(df[code_column].astype(object), sort=True)
+    days = get_day_numbers(df[date_column])
+    order = np.lexsort((days, codes))
+    if len(order) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, np.array([], dtype=object), empty, empty
+    # sorted key of the rows, code first: code * ndays + day (from the first day)
+    first_day = days.min()
+    ndays = days.max() - first_day + 1
+    key_size = ndays + 2
+    keys = codes[order] * key_size + days[order] - first_day
+    start_days = get_day_numbers([period['start'] for period in periods]) - first_day
+    end_days = get_day_numbers([period['end'] for period in periods]) - first_day
+    # out of range dates fall just before / after the days of each code
+    code_keys = np.arange(len(code_names)) * key_size
+    start_keys = code_keys + np.clip(start_days, 0, ndays)[:, None]
+    end_keys = code_keys + np.clip(end_days, -1, ndays - 1)[:, None]
+    start_pos = np.searchsorted(keys, start_keys.ravel(), side='left')
+    end_pos = np.searchsorted(keys, end_keys.ravel(), side='right') - 1
+    found = start_pos <= end_pos
+    period_index = np.repeat(np.arange(len(periods)), len(code_names))[found]
+    code = np.tile(np.asarray(code_names, dtype=object), len(periods))[found]
+    return period_index, code, order[start_pos[found]], order[end_pos[found]]
+
+
+def compare_periods(df, periods, code_column='ISO_3_CODE', date_column='date_epicrv'):
+    """
+    Increase of the cumulative cases and deaths and the case fatality rates at the
+    start and end of each period, for every code of df. Returns a dict of period
+    name -> table with one row per code, columns named with the period labels.
+    """
+    period_index, code, start_row, end_row = get_period_bounds(df, periods, code_column, date_column)
+    tables = {}
+    for iperiod, period in enumerate(periods):
+        start_label, end_label = period['labels']
+        selected = period_index == iperiod
+        table = {'iso3': code[selected]}
+        for label, rows in [(start_label, start_row[selected]), (end_label, end_row[selected])]:
+            for column, name in VALUE_COLUMNS.items():
+                table[f'{label}_{name}'] = df[column].values[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name in VALUE_COLUMNS.values():
+                start, end = table[f'{start_label}_{name}'], table[f'{end_label}_{name}']
+                table[f'increase_{name}'] = end - start
+                table[f'pc_increase_{name}'] = (end - start) / start * 100
+            for label in period['labels']:
+                table[f'CFR_{label}'] = table[f'{label}_deaths'] / table[f'{label}_cases'] * 100
+        tables[period['name']] = pd.DataFrame(table)
+    return tables
@@ -0,0 +1,206 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from utils.cache import CACHE_DIR, get_file_hash
+from utils.profiling import count, profile_stage
+
+# A graph of stages whose outputs are cached on disk by content. The cache key
+# of a stage is a hash of its code, its parameters, the files it reads and the
+# digests (hashes of the content) of its inputs' outputs, so a stage only runs
+# again when something it depends on actually changed: an input that is
+# recomputed to the same content does not invalidate what comes after it.
+# A stage also depends on the helpers and module constants it uses, so the key
+# includes a hash of all the Python files of the project: any change to the
+# code runs the stages again.
+DIR_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SOURCE_DIRS = [DIR_PATH, os.path.join(DIR_PATH, 'utils')]
+PIPELINE_CACHE_DIR = os.path.join(CACHE_DIR, 'pipeline')
+# cached outputs kept per stage, most recently used first
+MAX_CACHE_ENTRIES = 5
+
+
+def get_digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_source_digest(source_dirs=SOURCE_DIRS):
+    # hash of the Python files of source_dirs
+    filenames = sorted(filename for source_dir in source_dirs
+                       for filename in glob.glob(os.path.join(source_dir, '*.py')))
+    return get_digest({os.path.relpath(filename, DIR_PATH): get_file_hash(filename) for filename in filenames})
+
+
+def get_code(function):
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return f'{function.__module__}.{function.__qualname__}'
+
+
+class Stage:
+    """
+    A step of the pipeline, run as function(*outputs of inputs, **params, **options).
+    options are arguments that do not change the output (e.g. the number of
+    processes) and are not part of the cache key. sources are the files the stage
+    reads besides its inputs. A stage that writes files (files=True) returns their
+    names; it is also run again if one of them was changed or removed since.
+    """
+
+    def __init__(self, name, function, inputs=(), params=None, options=None, sources=(), files=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.params = dict(params or {})
+        self.options = dict(options or {})
+        self.sources = list(sources)
+        self.files = files
+
+    def get_key(self, input_digests, source_digest=None):
+        return get_digest(self.name, get_code(self.function), source_digest, self.params,
+                          [input_digests[name] for name in self.inputs],
+                          {filename: get_file_hash(filename) for filename in self.sources})
+
+
+class Pipeline:
+    """
+    Runs stages in dependency order, independent stages at the same time in up to
+    jobs threads (the stages can use process pools of their own), taking the
+    outputs that are already in the cache instead of running the stage.
+    """
+
+    def __init__(self, stages, cache_dir=PIPELINE_CACHE_DIR, force=False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.force = force
+        self.order = self.get_order()
+        self.source_digest = get_source_digest()
+        self.outputs = {}
+        self.lock = threading.Lock()
+
+    def get_order(self):
+        # topological order, raising on unknown inputs and cycles
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if name not in self.stages:
+                raise ValueError(f'Unknown pipeline stage "{name}" (input of "{path[-1]}")')
+            if state.get(name) == 'visiting':
+                raise ValueError(f'Cycle in the pipeline: {" -> ".join(path + [name])}')
+            if state.get(name) == 'done':
+                return
+            state[name] = 'visiting'
+            for input_name in self.stages[name].inputs:
+                visit(input_name, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.stages:
+            visit(name, [])
+        return order
+
+    def get_cache_filenames(self, name, key):
+        stage_dir = os.path.join(self.cache_dir, name)
+        return os.path.join(stage_dir, f'{key}.pkl'), os.path.join(stage_dir, f'{key}.json')
+
+    def read_manifest(self, stage, key):
+        # manifest of the cached output of stage for key, None if there is no valid one
+        output_filename, manifest_filename = self.get_cache_filenames(stage.name, key)
+        if self.force or not os.path.exists(manifest_filename) or not os.path.exists(output_filename):
+            return None
+        with open(manifest_filename, 'r') as stream:
+            manifest = json.load(stream)
+        if stage.files:
+            for filename, sha256 in manifest['files'].items():
+                if not os.path.exists(filename) or get_file_hash(filename) != sha256:
+                    return None
+        # mark it as recently used
+        os.utime(manifest_filename)
+        return manifest
+
+    def write_output(self, stage, key, output):
+        output_filename, manifest_filename = self.get_cache_filenames(stage.name, key)
+        os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+        data = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+        manifest = {'stage': stage.name, 'key': key, 'created': time.time()}
+        if stage.files:
+            manifest['files'] = {filename: get_file_hash(filename) for filename in output}
+            manifest['digest'] = get_digest(manifest['files'])
+        else:
+            manifest['digest'] = hashlib.sha256(data).hexdigest()
+        with open(f'{output_filename}.tmp', 'wb') as stream:
+            stream.write(data)
+        os.replace(f'{output_filename}.tmp', output_filename)
+        with open(manifest_filename, 'w') as stream:
+            json.dump(manifest, stream, indent=2)
+        self.prune(stage.name)
+        return manifest
+
+    def prune(self, name):
+        stage_dir = os.path.join(self.cache_dir, name)
+        manifests = sorted((filename for filename in os.listdir(stage_dir) if filename.endswith('.json')),
+                           key=lambda filename: os.path.getmtime(os.path.join(stage_dir, filename)), reverse=True)
+        for filename in manifests[MAX_CACHE_ENTRIES:]:
+            for extension in ['.json', '.pkl']:
+                path = os.path.join(stage_dir, filename[:-len('.json')] + extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def get_output(self, name, key):
+        # output of a finished stage, read from the cache the first time it is needed
+        with self.lock:
+            if name not in self.outputs:
+                with open(self.get_cache_filenames(name, key)[0], 'rb') as stream:
+                    self.outputs[name] = pickle.load(stream)
+            return self.outputs[name]
+
+    def report(self, message):
+        # one line per stage, the stages run in several threads
+        with self.lock:
+            print(message, flush=True)
+
+    def run_stage(self, stage, keys, digests):
+        key = stage.get_key(digests, self.source_digest)
+        manifest = self.read_manifest(stage, key)
+        if manifest is not None:
+            count('pipeline_cached_stages')
+            self.report(f'{stage.name}: up to date')
+            return key, manifest['digest']
+        inputs = [self.get_output(name, keys[name]) for name in stage.inputs]
+        start = time.perf_counter()
+        with profile_stage(stage.name):
+            output = stage.function(*inputs, **stage.params, **stage.options)
+        manifest = self.write_output(stage, key, output)
+        with self.lock:
+            self.outputs[stage.name] = output
+        self.report(f'{stage.name}: done in {time.perf_counter() - start:.2f} s')
+        return key, manifest['digest']
+
+    def run(self, jobs=1):
+        """
+        Bring every stage up to date. Returns the cache key of every stage; the
+        outputs can then be had with get_output.
+        """
+        keys, digests = {}, {}
+        pending = list(self.order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while pending or running:
+                for name in list(pending):
+                    if len(running) >= max(jobs, 1):
+                        break
+                    if all(input_name in digests for input_name in self.stages[name].inputs):
+                        pending.remove(name)
+                        running[executor.submit(self.run_stage, self.stages[name], keys, dict(digests))] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    keys[name], digests[name] = future.result()
+        return keys
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+from utils.growth_fit import get_day_numbers
+from utils.parallel import map_countries
+
+# Figures are drawn after the numbers are computed, from the output tables, one
+# file per country. matplotlib is only imported (with the non-interactive Agg
+# backend) when something is actually plotted, so runs without plots never load it.
+PLOTS_DIR = 'plots'
+PLOT_FORMATS = ['png', 'svg']
+TREND_QUANTITIES = ['weekly_new_cases_per_ht', 'weekly_new_cases_pc_change',
+                    'weekly_new_deaths_per_ht', 'weekly_new_deaths_pc_change']
+
+
+def add_plot_arguments(parser):
+    parser.add_argument('--plots-dir', default=PLOTS_DIR, help='Directory to save the plots in')
+    parser.add_argument('--plot-format', default='png', choices=PLOT_FORMATS, help='Format of the plots')
+
+
+def get_pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    pd.plotting.register_matplotlib_converters()
+    return plt
+
+
+def get_plot_filename(output_dir, name, iso3, plot_format):
+    return os.path.join(output_dir, f'{name}_{iso3}.{plot_format}')
+
+
+def render_panels(plot_function, panels, output_dir=PLOTS_DIR, name='plot', plot_format='png', workers=1):
+    # panels are (iso3, data) pairs; each one is drawn into its own file by plot_function(iso3, data, filename)
+    os.makedirs(output_dir, exist_ok=True)
+    iso3_list = [iso3 for iso3, _ in panels]
+    filenames = [get_plot_filename(output_dir, name, iso3, plot_format) for iso3 in iso3_list]
+    map_countries(plot_function, iso3_list, [data for _, data in panels], filenames, workers=workers)
+    print(f'Saved {len(filenames)} {name} plots to "{output_dir}"')
+    return filenames
+
+
+def plot_country_fits(iso3, data, filename):
+    # data: the country's series and, for every time range, its window fits
+    df_country, fits, time_range = data
+    plt = get_pyplot()
+    from matplotlib.collections import LineCollection
+    from matplotlib.dates import date2num
+    fig, axis = plt.subplots(figsize=[8, 6])
+    dates = np.array(df_country['date_epicrv'])
+    days = get_day_numbers(dates)
+    date_numbers = date2num(dates) if len(dates) else days
+    for time_type, df_fit in fits.items():
+        # all the fitted curves of a time range as a single collection
+        segments = []
+        for fit in df_fit[df_fit['doubling_time_fit'] >= 0].itertuples():
+            window = slice(int(fit.first_row), int(fit.last_row))
+            x = days[window] - days[window][-1] + time_range[time_type]
+            segments.append(np.column_stack([date_numbers[window], fit.p0 * np.exp(x * fit.beta)]))
+        color = 'r' if time_type == 'mid' else 'y'
+        axis.add_collection(LineCollection(segments, colors=color, alpha=0.2))
+    axis.plot(dates, df_country['CumCase'], 'ko', markersize=3, label=f'{iso3} - Original Data')
+    axis.plot([], [], 'r-', label=f'{iso3} - Fitted Curve')
+    axis.set_title(iso3)
+    axis.legend()
+    fig.autofmt_xdate()
+    fig.savefig(filename)
+    plt.close(fig)
+
+
+def plot_country_trend(iso3, group, filename):
+    # the weekly quantities of one country
+    plt = get_pyplot()
+    fig, axs = plt.subplots(figsize=[15, 10], nrows=2, ncols=2)
+    fig.suptitle(iso3)
+    for axis, q in zip(axs.flat, TREND_QUANTITIES):
+        if q in ['weekly_new_cases_pc_change', 'weekly_new_deaths_pc_change']:
+            idx = group[q] > 0
+            axis.bar(x=group['date_epicrv'][idx], height=group[q][idx], color='r')
+            idx = group[q] < 0
+            axis.bar(x=group['date_epicrv'][idx], height=group[q][idx], color='b')
+            axis.set_ylim(-100, 100)
+            axis.axhline(y=0, c='k')
+        else:
+            axis.plot(group['date_epicrv'], group[q])
+        axis.set_title(q)
+    fig.autofmt_xdate()
+    fig.savefig(filename)
+    plt.close(fig)
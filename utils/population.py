@@ -0,0 +1,93 @@
+import functools
+import os
+import re
+
+import pandas as pd
+
+from utils.cache import read_cached
+
+# Population from the World Bank workbook, converted once into a (iso3, year,
+# population) table kept in the on-disk cache until the workbook changes, and
+# held in memory as a country x year table for the lookups.
+DIR_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+POPULATION_FILENAME = 'Population_data/API_SP.POP.TOTL_DS2_en_excel_v2_1121005.xls'
+POPULATION_SHEET = 'Data'
+# year used when none is given: the most recent year with a value, per country
+LATEST_YEAR = 'latest'
+
+
+def read_population_xls(filename):
+    df = pd.read_excel(filename, sheet_name=POPULATION_SHEET, header=1, skiprows=[0, 1])
+    year_columns = [column for column in df.columns if re.fullmatch('[0-9]{4}', str(column))]
+    df = df.melt(id_vars='Country Code', value_vars=year_columns, var_name='year', value_name='population')
+    df = df.rename(columns={'Country Code': 'iso3'}).dropna(subset=['population'])
+    df['year'] = df['year'].astype(int)
+    return df.sort_values(['iso3', 'year']).reset_index(drop=True)
+
+
+def get_cache_name(filename):
+    return 'population_' + re.sub('[^A-Za-z0-9]+', '_', os.path.splitext(os.path.basename(filename))[0])
+
+
+class PopulationStore:
+    """
+    Population by iso3 and year. Countries are looked up in a country x year
+    table; the population of a set of countries or of country groups (through a
+    GroupRollup) is computed once per year and kept.
+    """
+
+    def __init__(self, df):
+        self.table = df.pivot(index='iso3', columns='year', values='population')
+        self.years = list(self.table.columns)
+        self.series = {}
+        self.group_totals = {}
+
+    def get_year(self, year=LATEST_YEAR):
+        if year == LATEST_YEAR:
+            return year
+        if not re.fullmatch('[0-9]+', str(year)):
+            raise ValueError(f'"{year}" is neither a year nor "{LATEST_YEAR}"')
+        if int(year) not in self.years:
+            raise ValueError(f'No population data for {year}, available years are {self.years[0]}-{self.years[-1]}')
+        return int(year)
+
+    def get_series(self, year=LATEST_YEAR):
+        # population of every country in year, or in its latest year with data
+        year = self.get_year(year)
+        if year not in self.series:
+            if year == LATEST_YEAR:
+                self.series[year] = self.table.ffill(axis=1).iloc[:, -1].rename('population')
+            else:
+                self.series[year] = self.table[year].rename('population')
+        return self.series[year]
+
+    def get(self, iso3, year=LATEST_YEAR):
+        return self.get_series(year).get(iso3)
+
+    def get_group_totals(self, rollup, year=LATEST_YEAR):
+        # population of each group of rollup (see GroupRollup.rollup_values)
+        year = self.get_year(year)
+        key = (tuple((name, tuple(iso3_list)) for name, iso3_list in rollup.groups.items()), year)
+        if key not in self.group_totals:
+            self.group_totals[key] = rollup.rollup_values(self.get_series(year)).rename('population')
+        return self.group_totals[key]
+
+
+def add_population_arguments(parser, default_year):
+    parser.add_argument('--population-year', default=default_year,
+                        help=f'Year of the population data, or "{LATEST_YEAR}" for the latest year of each country')
+
+
+def get_population_year_from_args(parser, args):
+    # --population-year, checked against the years of the population data
+    try:
+        return get_population_store().get_year(args.population_year)
+    except ValueError as err:
+        parser.error(f'--population-year: {err}')
+
+
+@functools.lru_cache(maxsize=None)
+def get_population_store(filename=POPULATION_FILENAME):
+    filename = os.path.join(DIR_PATH, filename)
+    return PopulationStore(read_cached(get_cache_name(filename), filename, read_population_xls,
+                                       key={'sheet': POPULATION_SHEET}))
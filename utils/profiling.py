@@ -0,0 +1,146 @@
+import contextlib
+import cProfile
+import datetime
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then not reported
+    resource = None
+
+# Stage timings and event counters of a run. Stages are always timed (it costs a
+# couple of clock reads per stage); the report is only written with --profile.
+# Work done in worker processes is recorded there and merged back by map_countries.
+# The peak RSS of the process only ever grows: a stage records by how much it grew
+# while the stage ran (0 if the stage stayed below the peak of what ran before),
+# the peak of the whole run is in the report.
+
+
+def get_peak_rss():
+    # peak resident set size of the process in bytes
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+class Profiler:
+    """
+    Wall time, CPU time, growth of the peak RSS and number of calls of named
+    stages, plus named counters (e.g. curve_fit calls and failures). A stage can
+    be given an item (e.g. the iso3 of the country being fitted) to also keep its
+    time per item.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, item=None):
+        wall_start, cpu_start, rss_start = time.perf_counter(), time.process_time(), get_peak_rss()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            rss_increase = get_peak_rss() - rss_start if rss_start is not None else None
+            self.add_stage(name, {'calls': 1, 'wall_time': wall_time, 'cpu_time': time.process_time() - cpu_start,
+                                  'peak_rss_increase': rss_increase,
+                                  'items': {str(item): wall_time} if item is not None else {}})
+
+    def add_stage(self, name, stats):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall_time': 0., 'cpu_time': 0., 'peak_rss_increase': None, 'items': {}}
+        total = self.stages[name]
+        total['calls'] += stats['calls']
+        total['wall_time'] += stats['wall_time']
+        total['cpu_time'] += stats['cpu_time']
+        if stats['peak_rss_increase'] is not None:
+            total['peak_rss_increase'] = (total['peak_rss_increase'] or 0) + stats['peak_rss_increase']
+        for item, wall_time in stats['items'].items():
+            total['items'][item] = total['items'].get(item, 0.) + wall_time
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, profile):
+        # add the stages and counters of another run, as returned by to_dict
+        for name, stats in profile['stages'].items():
+            self.add_stage(name, stats)
+        for name, n in profile['counters'].items():
+            self.count(name, n)
+
+    def to_dict(self):
+        return {'stages': self.stages, 'counters': self.counters}
+
+    def print_summary(self):
+        print(f'{"stage":<16}{"calls":>7}{"wall [s]":>10}{"cpu [s]":>10}{"peak RSS + [MB]":>17}')
+        for name, stats in self.stages.items():
+            rss_increase = stats['peak_rss_increase']
+            rss_increase = f'{rss_increase / 1e6:>17.1f}' if rss_increase is not None else f'{"-":>17}'
+            print(f'{name:<16}{stats["calls"]:>7}{stats["wall_time"]:>10.3f}{stats["cpu_time"]:>10.3f}{rss_increase}')
+        for name, n in self.counters.items():
+            print(f'{name}: {n}')
+
+
+PROFILER = Profiler()
+
+
+def add_profile_arguments(parser, default_filename):
+    parser.add_argument('--profile', nargs='?', const=default_filename, metavar='FILENAME',
+                        help='Save the time, CPU and memory use of each stage (default %(const)s)')
+    parser.add_argument('--profile-stats', metavar='FILENAME',
+                        help='Also run cProfile (this process only) and save its stats')
+
+
+def profile_stage(name, item=None):
+    return PROFILER.stage(name, item)
+
+
+def count(name, n=1):
+    PROFILER.count(name, n)
+
+
+def run_profiled(function, *args):
+    # Call function with a fresh profiler and return its result along with what
+    # was recorded, for worker processes whose profile is merged by the parent
+    global PROFILER
+    parent, PROFILER = PROFILER, Profiler()
+    try:
+        return function(*args), PROFILER.to_dict()
+    finally:
+        PROFILER = parent
+
+
+@contextlib.contextmanager
+def profile_run(report_filename=None, stats_filename=None):
+    """
+    Profile the enclosed run: if report_filename is given, write the stages and
+    counters recorded meanwhile to it as JSON and print them; if stats_filename
+    is given, also run cProfile and dump its pstats there.
+    """
+    profiler = cProfile.Profile() if stats_filename else None
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield PROFILER
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(stats_filename)
+            print(f'Saved cProfile stats to "{stats_filename}"')
+        if report_filename:
+            report = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'argv': sys.argv,
+                      'wall_time': time.perf_counter() - wall_start, 'cpu_time': time.process_time() - cpu_start,
+                      'peak_rss': get_peak_rss(), **PROFILER.to_dict()}
+            with open(report_filename, 'w') as stream:
+                json.dump(report, stream, indent=2)
+            PROFILER.print_summary()
+            if report['peak_rss'] is not None:
+                print(f'peak RSS of the process: {report["peak_rss"] / 1e6:.1f} MB')
+            print(f'Saved profile to "{report_filename}"')
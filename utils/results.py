@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+
+class ResultCollector:
+    """
+    Accumulates output rows keyed by e.g. (iso3, date) in preallocated NumPy columns
+    and builds the DataFrame once at the end, instead of appending to a DataFrame
+    in a loop. Value columns are float unless another dtype is given; they are added
+    in order of first use, like columns created with DataFrame.loc.
+    """
+
+    def __init__(self, key_columns, value_columns=(), dtypes=None, capacity=1024):
+        self.key_columns = list(key_columns)
+        self.dtypes = dict(dtypes or {})
+        self.capacity = capacity
+        self.nrows = 0
+        self.index = {}
+        self.keys = {name: np.empty(capacity, dtype=object) for name in self.key_columns}
+        self.values = {}
+        for name in value_columns:
+            self.add_column(name)
+
+    def add_column(self, name):
+        dtype = np.dtype(self.dtypes.get(name, float))
+        fill_value = np.nan if dtype.kind == 'f' else 0
+        self.values[name] = np.full(self.capacity, fill_value, dtype=dtype)
+
+    def grow(self):
+        self.capacity *= 2
+        for columns in (self.keys, self.values):
+            for name, column in columns.items():
+                new_column = np.empty(self.capacity, dtype=column.dtype)
+                new_column[len(column):] = np.nan if column.dtype.kind == 'f' else 0
+                new_column[:len(column)] = column
+                columns[name] = new_column
+
+    def set(self, key, create=True, **values):
+        # Set the values of the row with this key. With create=False rows that do not
+        # exist yet are left alone (the columns are still registered).
+        for name in values:
+            if name not in self.values:
+                self.add_column(name)
+        row = self.index.get(key)
+        if row is None:
+            if not create:
+                return
+            if self.nrows == self.capacity:
+                self.grow()
+            row = self.nrows
+            self.index[key] = row
+            for name, value in zip(self.key_columns, key):
+                self.keys[name][row] = value
+            self.nrows += 1
+        for name, value in values.items():
+            self.values[name][row] = value
+
+    def extend(self, df):
+        # Add the rows of a DataFrame that has the key columns and some of the value columns
+        value_columns = [name for name in df.columns if name not in self.key_columns]
+        for record in df.to_dict('records'):
+            key = tuple(record[name] for name in self.key_columns)
+            self.set(key, **{name: record[name] for name in value_columns})
+
+    def to_dataframe(self):
+        columns = {name: column[:self.nrows] for name, column in self.keys.items()}
+        columns.update({name: column[:self.nrows] for name, column in self.values.items()})
+        return pd.DataFrame(columns, columns=list(columns))
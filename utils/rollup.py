@@ -0,0 +1,87 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from utils.countries import get_group_definitions
+
+# rollups of the standard group definitions, by country list
+GROUP_ROLLUPS = {}
+
+
+class GroupRollup:
+    """
+    Sums of country data over groups of countries (H63, H25, regions, ...).
+    The groups are given as an ordered dict of group name -> list of iso3 and turned
+    into a sparse group x country membership matrix, so that the series of every group
+    come out of a single matrix product. Results are cached per input table, so
+    adding groups or asking for the same rollup twice costs next to nothing.
+    """
+
+    def __init__(self, groups):
+        self.groups = dict(groups)
+        self.countries = sorted(set(iso3 for iso3_list in self.groups.values() for iso3 in iso3_list))
+        country_index = {iso3: i for i, iso3 in enumerate(self.countries)}
+        rows = [igroup for igroup, iso3_list in enumerate(self.groups.values()) for _ in set(iso3_list)]
+        cols = [country_index[iso3] for iso3_list in self.groups.values() for iso3 in set(iso3_list)]
+        self.membership = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                            shape=(len(self.groups), len(self.countries)))
+        self.cache = {}
+
+    def get_country_codes(self, iso3):
+        # position of each iso3 in the membership matrix, -1 if it is in no group
+        return pd.Categorical(iso3, categories=self.countries).codes
+
+    def get_cache_key(self, df, *args):
+        digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes()).hexdigest()
+        return (digest,) + args
+
+    def rollup_series(self, df, value_columns, date_column='date_epicrv', code_column='ISO_3_CODE'):
+        """
+        Sum value_columns of the countries of each group, by date. A group has a row
+        for every date on which at least one of its countries reported, like a
+        groupby(date).sum() of the group's countries. Rows come group by group in the
+        order of the definitions, dates sorted.
+        """
+        key = self.get_cache_key(df[[date_column, code_column] + list(value_columns)], date_column, code_column)
+        if key not in self.cache:
+            self.cache[key] = self.compute_series(df, value_columns, date_column, code_column)
+        return self.cache[key].copy()
+
+    def compute_series(self, df, value_columns, date_column, code_column):
+        country_codes = self.get_country_codes(df[code_column].astype(object))
+        df = df[country_codes >= 0]
+        country_codes = country_codes[country_codes >= 0]
+        date_codes, dates = pd.factorize(df[date_column], sort=True)
+        ndates = len(dates)
+        # country x (column, date) table, plus a last block counting the reports
+        table = np.zeros((len(self.countries), (len(value_columns) + 1) * ndates))
+        for icolumn, column in enumerate(value_columns):
+            values = df[column].values.astype(float)
+            np.add.at(table, (country_codes, icolumn * ndates + date_codes), np.nan_to_num(values))
+        np.add.at(table, (country_codes, len(value_columns) * ndates + date_codes), 1)
+        sums = self.membership @ table
+        reported = sums[:, len(value_columns) * ndates:] > 0
+        group_index, date_index = np.nonzero(reported)
+        output_df = pd.DataFrame({date_column: dates[date_index],
+                                  code_column: np.array(list(self.groups), dtype=object)[group_index]})
+        for icolumn, column in enumerate(value_columns):
+            values = sums[:, icolumn * ndates:(icolumn + 1) * ndates][group_index, date_index]
+            if df[column].dtype.kind in 'iu':
+                values = np.rint(values).astype(df[column].dtype)
+            output_df[column] = values
+        return output_df
+
+    def rollup_values(self, values):
+        # Group totals of a Series indexed by iso3 (e.g. the population), missing values count as 0
+        values = values.reindex(self.countries).fillna(0).values.astype(float)
+        return pd.Series(self.membership @ values, index=list(self.groups))
+
+
+def get_group_rollup(H63_iso3, custom_groups=True, regions=True):
+    # Rollup of the standard groups (see get_group_definitions), built once per country list
+    key = (tuple(H63_iso3), custom_groups, regions)
+    if key not in GROUP_ROLLUPS:
+        GROUP_ROLLUPS[key] = GroupRollup(get_group_definitions(H63_iso3, custom_groups, regions))
+    return GROUP_ROLLUPS[key]
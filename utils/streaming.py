@@ -0,0 +1,239 @@
+import numpy as np
+import pandas as pd
+
+from utils.growth_fit import fit_windows, get_day_numbers, get_dense_series
+from utils.weekly import aggregate_weekly, get_week_codes
+from utils.who_data import WHO_COLUMNS, WHO_DTYPES
+
+# Out-of-core processing of WHO style series that do not fit in memory (e.g.
+# sub-national or several years of data). The CSV is read in chunks and has to be
+# partitioned by ISO3 and date: all the rows of a code one after the other, in
+# date order, like the WHO file. Each code is run through a small state holding
+# only what the next rows need (the rows of the last weeks, the rows of the
+# longest fit window) and its results are handed on as soon as they are final,
+# so memory does not grow with the input. Sums over groups of countries are kept
+# as one row per group and date and processed once the input is read.
+STREAM_CHUNK_SIZE = 100000
+NANOSECONDS_PER_DAY = 86400 * 10 ** 9
+
+
+def read_who_chunks(filename, iso3_list=None, chunksize=STREAM_CHUNK_SIZE):
+    # the rows of read_who_csv, chunksize rows of the file at a time
+    dtypes = dict(WHO_DTYPES, ISO_3_CODE=str)
+    for df in pd.read_csv(filename, usecols=WHO_COLUMNS, dtype=dtypes, chunksize=chunksize):
+        if iso3_list is not None:
+            df = df[df['ISO_3_CODE'].isin(iso3_list)]
+        df['date_epicrv'] = pd.to_datetime(df['date_epicrv'])
+        yield df[WHO_COLUMNS]
+
+
+def split_runs(df, code_column='ISO_3_CODE'):
+    # (code, rows) of every run of consecutive rows with the same code, in order
+    codes = df[code_column].to_numpy()
+    if len(codes) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    stops = np.r_[starts[1:], len(codes)]
+    return [(codes[start], df.iloc[start:stop]) for start, stop in zip(starts, stops)]
+
+
+class GroupStream:
+    """
+    Feeds the rows of a table partitioned by code to a state per code, made by
+    make_state(code), with update(rows) and finish() methods returning a result or
+    None. Only the state of the current code is kept: it is finished as soon as
+    the next code starts. update and finish return the (code, result) pairs that
+    came out.
+    """
+
+    def __init__(self, make_state, code_column='ISO_3_CODE', date_column='date_epicrv'):
+        self.make_state = make_state
+        self.code_column = code_column
+        self.date_column = date_column
+        self.code = None
+        self.state = None
+        self.last_day = None
+        self.finished = set()
+
+    def update(self, df):
+        results = []
+        for code, rows in split_runs(df, self.code_column):
+            if code != self.code:
+                results += self.finish()
+                if code in self.finished:
+                    raise ValueError(f'The input is not partitioned by {self.code_column}: '
+                                     f'the rows of {code} are not one after the other')
+                self.code, self.state, self.last_day = code, self.make_state(code), None
+            days = get_day_numbers(rows[self.date_column])
+            if np.any(np.diff(days) <= 0) or (self.last_day is not None and days[0] <= self.last_day):
+                raise ValueError(f'The rows of {code} are not in date order')
+            self.last_day = days[-1]
+            results.append((code, self.state.update(rows)))
+        return [(code, result) for code, result in results if result is not None]
+
+    def finish(self):
+        if self.state is None:
+            return []
+        code, result = self.code, self.state.finish()
+        self.finished.add(code)
+        self.code, self.state = None, None
+        return [] if result is None else [(code, result)]
+
+
+class WeeklyState:
+    """
+    Weekly aggregation (see aggregate_weekly) of one code. Keeps the rows of the
+    week in progress and of the last complete week, the one the next week is
+    compared with, and returns the weeks that are complete.
+    """
+
+    def __init__(self, anchor='W-SUN', date_column='date_epicrv'):
+        self.anchor = anchor
+        self.date_column = date_column
+        self.rows = None
+        # week of the last complete week returned
+        self.last_week = None
+
+    def get_weeks(self, rows):
+        return get_week_codes(get_day_numbers(rows[self.date_column]), self.anchor)
+
+    def update(self, rows):
+        rows = rows if self.rows is None else pd.concat([self.rows, rows], ignore_index=True)
+        weeks = self.get_weeks(rows)
+        # the last week can still get rows
+        output_df = self.aggregate(rows[weeks < weeks[-1]])
+        previous_week = self.last_week if self.last_week is not None else weeks[-1]
+        self.rows = rows[(weeks == previous_week) | (weeks == weeks[-1])]
+        return output_df
+
+    def finish(self):
+        return None if self.rows is None else self.aggregate(self.rows)
+
+    def aggregate(self, rows):
+        # the complete weeks of rows that were not returned yet
+        output_df = aggregate_weekly(rows, self.anchor, date_column=self.date_column)
+        if len(output_df) == 0:
+            return None
+        weeks = get_day_numbers(output_df[self.date_column])
+        if self.last_week is not None:
+            output_df = output_df[weeks > self.last_week]
+        self.last_week = weeks[-1]
+        return output_df if len(output_df) else None
+
+
+class WindowFitState:
+    """
+    Fits of the windows of one code (see fit_windows) for every time range of
+    time_ranges, on the rows whose value_column is above min_value. A window ends
+    on every row from the max(time_ranges)-th one on, as in the whole series, and
+    only the rows a later window can reach are kept. Returns the end days of the
+    new windows, in date order, and their fits by time range.
+    """
+
+    def __init__(self, time_ranges, value_column='CumCase', min_value=0, date_column='date_epicrv'):
+        self.time_ranges = time_ranges
+        self.value_column = value_column
+        self.min_value = min_value
+        self.date_column = date_column
+        self.window_size = max(time_ranges.values())
+        # the last window_size + 1 rows (the one before the window for the gap filling)
+        self.days = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0)
+        self.nrows = 0
+
+    def update(self, rows):
+        rows = rows[rows[self.value_column] > self.min_value]
+        if len(rows) == 0:
+            return None
+        days = np.concatenate([self.days, get_day_numbers(rows[self.date_column])])
+        values = np.concatenate([self.values, rows[self.value_column].to_numpy(dtype=float)])
+        # rows of the whole series, from the first new one
+        row_numbers = self.nrows + np.arange(len(rows))
+        end_days = days[len(self.days):][row_numbers >= self.window_size - 1]
+        self.nrows += len(rows)
+        self.days, self.values = days[-(self.window_size + 1):], values[-(self.window_size + 1):]
+        if len(end_days) == 0:
+            return None
+        dense_series = get_dense_series(days, values)
+        return end_days, {time_type: fit_windows(days, values, end_days, time_range, dense_series)
+                          for time_type, time_range in self.time_ranges.items()}
+
+    def finish(self):
+        return None
+
+
+class StreamingRollup:
+    """
+    Sums over the groups of a GroupRollup of the chunks given to add, as one row
+    per group and date (GroupRollup.rollup_series of the whole table). The sums
+    are kept in a group x day array, grown as new days come, so adding a chunk
+    only costs its own rows.
+    """
+
+    def __init__(self, rollup, value_columns, date_column='date_epicrv', code_column='ISO_3_CODE'):
+        self.rollup = rollup
+        self.value_columns = list(value_columns)
+        self.date_column = date_column
+        self.code_column = code_column
+        # (group, day, column) sums from first_day on, whether a group has a row on
+        # a day, and the date of each day (as UTC nanoseconds)
+        self.first_day = None
+        self.sums = None
+        self.reported = None
+        self.dates = None
+        self.dtypes = None
+
+    def reserve(self, first_day, last_day, dtype):
+        # make room for the days from first_day to last_day
+        if self.sums is None:
+            self.first_day, ndays = first_day, 0
+        else:
+            ndays = self.sums.shape[1]
+            if first_day >= self.first_day and last_day < self.first_day + ndays:
+                return
+        new_first_day = min(first_day, self.first_day)
+        # at least twice as many days, so that growing one chunk at a time is not quadratic
+        new_ndays = max(max(last_day, self.first_day + ndays - 1) - new_first_day + 1, 2 * ndays)
+        sums = np.zeros((len(self.rollup.groups), new_ndays, len(self.value_columns)), dtype=dtype)
+        reported = np.zeros((len(self.rollup.groups), new_ndays), dtype=bool)
+        dates = np.zeros(new_ndays, dtype=np.int64)
+        if self.sums is not None:
+            offset = self.first_day - new_first_day
+            sums[:, offset:offset + ndays] = self.sums
+            reported[:, offset:offset + ndays] = self.reported
+            dates[offset:offset + ndays] = self.dates
+        self.first_day, self.sums, self.reported, self.dates = new_first_day, sums, reported, dates
+
+    def add(self, df):
+        # rollup_series caches its results by table, which is of no use here
+        sums = self.rollup.compute_series(df, self.value_columns, self.date_column, self.code_column)
+        if len(sums) == 0:
+            return
+        if self.dtypes is None:
+            self.dtypes = sums.dtypes
+        values = sums[self.value_columns].to_numpy()
+        # UTC nanoseconds, and days from them like get_day_numbers
+        stamps = pd.DatetimeIndex(sums[self.date_column]).asi8
+        days = stamps // NANOSECONDS_PER_DAY
+        self.reserve(days.min(), days.max(), values.dtype)
+        # one row per group and date in a chunk
+        index = (pd.Categorical(sums[self.code_column], categories=list(self.rollup.groups)).codes,
+                 days - self.first_day)
+        self.sums[index] += values
+        self.reported[index] = True
+        self.dates[index[1]] = stamps
+
+    def get_series(self):
+        # groups in the order of the definitions, dates sorted
+        columns = [self.date_column, self.code_column] + self.value_columns
+        if self.sums is None:
+            return pd.DataFrame(columns=columns)
+        group_index, day_index = np.nonzero(self.reported)
+        dates = pd.DatetimeIndex(self.dates[day_index])
+        if isinstance(self.dtypes[self.date_column], pd.DatetimeTZDtype):
+            dates = dates.tz_localize('UTC').tz_convert(self.dtypes[self.date_column].tz)
+        df = pd.DataFrame({self.date_column: dates,
+                           self.code_column: np.array(list(self.rollup.groups), dtype=object)[group_index]})
+        for icolumn, column in enumerate(self.value_columns):
+            df[column] = self.sums[group_index, day_index, icolumn]
+        return df.astype(self.dtypes[columns])
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+# Weekly aggregation of the daily WHO series in a single grouped pass: rows are
+# sorted by (group, week) and every statistic is a NumPy reduceat over the same
+# week boundaries.
+WEEKDAYS = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+# 'W-<DAY>' are pandas style weeks ending on (and labelled with) that day,
+# 'ISO' are ISO weeks (Monday to Sunday) labelled with their Monday
+WEEK_ANCHORS = [f'W-{day}' for day in WEEKDAYS] + ['ISO']
+SUM_COLUMNS = ['NewCase', 'NewDeath']
+MIN_COLUMNS = ['CumCase', 'CumDeath']
+COUNT_COLUMN = 'NewCase'
+DAYS_IN_WEEK = 7
+
+
+def get_week_codes(days, anchor='W-SUN'):
+    # Day number of the label of the week each day falls in. days are days since
+    # 1970-01-01, which was a Thursday.
+    weekday = (days + 3) % 7
+    if anchor == 'ISO':
+        return days - weekday
+    if anchor not in WEEK_ANCHORS:
+        raise ValueError(f'Unknown week anchor "{anchor}", use one of {WEEK_ANCHORS}')
+    end_weekday = WEEKDAYS.index(anchor.split('-')[1])
+    return days + (end_weekday - weekday) % 7
+
+
+def reduce_weeks(ufunc, values, starts):
+    if values.dtype.kind == 'f':
+        # skip missing values like the pandas reductions do
+        identity = 0. if ufunc is np.add else np.nan
+        values = np.where(np.isnan(values), identity, values)
+        if ufunc is np.minimum:
+            ufunc = np.fmin
+    return ufunc.reduceat(values, starts)
+
+
+def get_weekly_changes(values, new_group):
+    # week over week difference and relative change, restarting for every group
+    previous = np.empty(len(values))
+    previous[:1] = np.nan
+    previous[1:] = values[:-1]
+    previous[new_group] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # same arithmetic as pandas pct_change
+        pct_change = values / previous - 1
+    return values - previous, pct_change
+
+
+def aggregate_weekly(df, anchor='W-SUN', group_column='ISO_3_CODE', date_column='date_epicrv'):
+    """
+    Weekly new case/death sums, minimum cumulative cases/deaths and number of reported
+    days per group, keeping only complete weeks, plus week over week changes of the
+    new cases and deaths. Groups come out sorted, weeks in date order.
+    """
+    if len(df) == 0:
+        return pd.DataFrame(columns=[group_column, date_column] + SUM_COLUMNS + MIN_COLUMNS +
+                            ['ndays', 'NewCase_PercentChange', 'NewDeath_PercentChange', 'diff_cases', 'diff_deaths'])
+    dates = pd.to_datetime(df[date_column])
+    tz = dates.dt.tz
+    days = dates.dt.tz_localize(None).values.astype('datetime64[D]').astype(np.int64)
+    group_codes, groups = pd.factorize(df[group_column].astype(object), sort=True)
+    weeks = get_week_codes(days, anchor)
+    order = np.lexsort((weeks, group_codes))
+    group_codes = group_codes[order]
+    weeks = weeks[order]
+    # first row of every (group, week)
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = (group_codes[1:] != group_codes[:-1]) | (weeks[1:] != weeks[:-1])
+    starts = np.flatnonzero(is_start)
+    output = {}
+    for column in SUM_COLUMNS:
+        output[column] = reduce_weeks(np.add, df[column].values[order], starts)
+    for column in MIN_COLUMNS:
+        output[column] = reduce_weeks(np.minimum, df[column].values[order], starts)
+    reported = pd.notna(df[COUNT_COLUMN].values[order]).astype(np.int64)
+    output['ndays'] = np.add.reduceat(reported, starts)
+    # complete weeks only
+    full = output['ndays'] == DAYS_IN_WEEK
+    week_groups = group_codes[starts][full]
+    week_dates = pd.to_datetime(weeks[starts][full].astype('datetime64[D]'))
+    if tz is not None:
+        week_dates = week_dates.tz_localize(tz)
+    output_df = pd.DataFrame({group_column: groups[week_groups], date_column: week_dates})
+    for column, values in output.items():
+        output_df[column] = values[full]
+    new_group = np.ones(len(week_groups), dtype=bool)
+    new_group[1:] = week_groups[1:] != week_groups[:-1]
+    diff_cases, pct_cases = get_weekly_changes(output_df['NewCase'].values, new_group)
+    diff_deaths, pct_deaths = get_weekly_changes(output_df['NewDeath'].values, new_group)
+    # For percent change, if the diff is actually 0, change nan to 0
+    pct_cases[np.isnan(pct_cases) & (diff_cases == 0)] = 0.0
+    pct_deaths[np.isnan(pct_deaths) & (diff_deaths == 0)] = 0.0
+    output_df['NewCase_PercentChange'] = pct_cases
+    output_df['NewDeath_PercentChange'] = pct_deaths
+    output_df['diff_cases'] = diff_cases
+    output_df['diff_deaths'] = diff_deaths
+    return output_df
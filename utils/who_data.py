@@ -0,0 +1,33 @@
+import os
+import re
+
+import pandas as pd
+
+from utils.cache import CACHE_DIR, read_cached
+
+# Columns of the WHO COVID-19 file used by the analysis, and their types
+WHO_COLUMNS = ['date_epicrv', 'ISO_3_CODE', 'NewCase', 'CumCase', 'NewDeath', 'CumDeath']
+WHO_DTYPES = {'ISO_3_CODE': 'category', 'NewCase': 'int64', 'CumCase': 'int64',
+              'NewDeath': 'int64', 'CumDeath': 'int64'}
+WHO_NUMERIC_COLUMNS = ['NewCase', 'CumCase', 'NewDeath', 'CumDeath']
+
+
+def read_who_csv(filename):
+    df = pd.read_csv(filename, usecols=WHO_COLUMNS, dtype=WHO_DTYPES)
+    df['date_epicrv'] = pd.to_datetime(df['date_epicrv'])
+    return df[WHO_COLUMNS]
+
+
+def get_cache_name(filename):
+    return 'who_' + re.sub('[^A-Za-z0-9]+', '_', os.path.splitext(os.path.basename(filename))[0])
+
+
+def get_who_data(filename, iso3_list=None, cache_dir=CACHE_DIR):
+    # WHO data with parsed dates and a categorical ISO_3_CODE. The parsed file is
+    # kept (in cache_dir) as a snapshot that is reused until the CSV changes.
+    df = read_cached(get_cache_name(filename), filename, read_who_csv,
+                     key={'columns': WHO_COLUMNS, 'dtypes': WHO_DTYPES}, cache_dir=cache_dir)
+    if iso3_list is not None:
+        df = df.loc[df['ISO_3_CODE'].isin(iso3_list), :].copy()
+        df['ISO_3_CODE'] = df['ISO_3_CODE'].cat.remove_unused_categories()
+    return df